@@ -25,23 +25,6 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
             print 'Turning on gas particle refinement.'
             self.refine_dataset()
 
-    def __getstate__(self):
-        result = self.__dict__.copy()
-        del result['_coordinates']
-        del result['_particleIDs']
-        del result['_velocities']
-        del result['_masses']
-        del result['_adiabatic_index']
-        del result['_abundances']
-        del result['_density']
-        del result['_sink_value']
-        del result['_smoothing_length']
-        del result['_internal_energy']
-        del result['_load_dict']
-        del result['loadable_keys']
-        del result['_calculated']
-        return result
-
     def __setstate__(self, in_dict):
         self.__dict__ = in_dict
         self.__init_load_dict__()
@@ -78,25 +61,39 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
             criterion = (self.masses > self.masses.min()) & (self.sink_value == 0.)
         super(PartTypeNbody, self).refine_dataset(criterion)
 
+    def _conversion(self, key, unit=None):
+        """
+        Return the factor converting dataset key from code units to unit
+        (default set in units class).
+        """
+        if key == 'density':
+            conv = self.units.densities[unit or self.units.density_unit]
+            if self.units.remove_h:
+                conv *= self._header.HubbleParam**2
+            if self.units.coordinate_system == 'physical':
+                ainv = self._header.Redshift + 1 # 1/(scale factor)
+                conv *= ainv**3
+        elif key == 'internal_energy':
+            conv = self.units.energies[unit or self.units.energy_unit]
+        elif key == 'smoothing_length':
+            conv = self.units.lengths[unit or self.units.length_unit]
+            if self.units.remove_h:
+                conv /= self._header.HubbleParam
+            if self.units.coordinate_system == 'physical':
+                conv *= self._header.ScaleFactor
+        else:
+            conv = super(PartTypeCustom, self)._conversion(key, unit)
+        return conv
+
     def load_density(self, unit=None):
         """
         Load Particle Densities in cgs units (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_density(unit)
-        density = self._density.value * self.units.density_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            density *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            density *= ainv**3
-        if self._drop_ids is not None:
-            density = Series(density, index=self._particleIDs.value)
-            self['density'] = density.drop(self._drop_ids)
-        else:
-            self['density'] = density
+        unit = unit or self.units.density_unit
+        density = self._converted('density', unit)
+        self._store(density, 'density')
+        self._loaded_units['density'] = unit
 
     def get_density(self, unit=None):
         """
@@ -104,7 +101,7 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.density_unit:
+            if unit != self._loaded_units.get('density'):
                 self.load_density(unit)
         try:
             return self.density
@@ -117,21 +114,11 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         Load Particle Number Densities in cgs units (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_density(unit)
-        ndensity = self._density.value * self.units.density_conv \
+        unit = unit or self.units.density_unit
+        ndensity = self._converted('density', unit) \
                    * constants.X_h / constants.m_H
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            ndensity *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            ndensity *= ainv**3
-        if self._drop_ids is not None:
-            ndensity = Series(ndensity, index=self._particleIDs.value)
-            self['ndensity'] = ndensity.drop(self._drop_ids)
-        else:
-            self['ndensity'] = ndensity
+        self._store(ndensity, 'ndensity')
+        self._loaded_units['ndensity'] = unit
 
     def get_number_density(self, unit=None):
         """
@@ -139,7 +126,7 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.density_unit:
+            if unit != self._loaded_units.get('ndensity'):
                 self.load_number_density(unit)
         try:
             return self.ndensity
@@ -153,14 +140,10 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_energy(unit)
-        energy = self._internal_energy.value * self.units.energy_conv
-        if self._drop_ids is not None:
-            energy = Series(energy, index=self._particleIDs.value)
-            self['internal_energy'] = energy.drop(self._drop_ids)
-        else:
-            self['internal_energy'] = energy
+        unit = unit or self.units.energy_unit
+        energy = self._converted('internal_energy', unit)
+        self._store(energy, 'internal_energy')
+        self._loaded_units['internal_energy'] = unit
 
     def get_internal_energy(self, unit=None):
         """
@@ -168,7 +151,7 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.energy_unit:
+            if unit != self._loaded_units.get('internal_energy'):
                 self.load_internal_energy(unit)
         try:
             return self.internal_energy
@@ -180,12 +163,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         Load particle adiabatic index.
         """
-        gamma = self._Adiabatic_index.value
-        if self._drop_ids is not None:
-            gamma = Series(gamma, index=self._particleIDs.value)
-            self['adiabatic_index'] = gamma.drop(self._drop_ids)
-        else:
-            self['adiabatic_index'] = gamma
+        gamma = self._read('Adiabatic_index')
+        self._store(gamma, 'adiabatic_index')
 
     def get_adiabatic_index(self):
         """
@@ -203,20 +182,10 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units._set_smoothing_length(unit)
-        hsml = self._smoothing_length.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            hsml /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            hsml *= a
-        if self._drop_ids is not None:
-            hsml = Series(hsml, index=self._particleIDs.value)
-            self['smoothing_length'] = hsml.drop(self._drop_ids)
-        else:
-            self['smoothing_length'] = hsml
+        unit = unit or self.units.length_unit
+        hsml = self._converted('smoothing_length', unit)
+        self._store(hsml, 'smoothing_length')
+        self._loaded_units['smoothing_length'] = unit
 
     def get_smoothing_length(self, unit=None):
         """
@@ -225,7 +194,7 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units._smoothing_unit:
+            if unit != self._loaded_units.get('smoothing_length'):
                 self.load_smoothing_length(unit)
         try:
             return self.smoothing_length
@@ -237,12 +206,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         Load particle by particle sink flag values.
         """
-        sinks = self._sink_value.value
-        if self._drop_ids is not None:
-            sinks = Series(sinks, index=self._particleIDs.value)
-            self['sink_value'] = sinks.drop(self._drop_ids)
-        else:
-            self['sink_value'] = sinks
+        sinks = self._read('sink_value')
+        self._store(sinks, 'sink_value')
 
     def get_sinks(self):
         """
@@ -264,12 +229,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         default_species = ['H2', 'HII', 'DII', 'HD', 'HeII', 'HeIII']
         if tracked_species is None:
             tracked_species = default_species
-        abundances = self._ChemicalAbundances.value
-        abundances = DataFrame(abundances, index=self._particleIDs.value,
-                               columns=tracked_species)
-        if self._drop_ids is not None:
-            abundances.drop(self._drop_ids)
-        self[tracked_species] = abundances
+        abundances = self._read('ChemicalAbundances')
+        self._store(abundances, *tracked_species)
 
     def get_abundances(self, *species, **kwargs):
         """
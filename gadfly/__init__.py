@@ -4,11 +4,14 @@ from a modified version of the SPH code Gadget2.
 """
 import units
 import coordinates
+import cache
 
 import hdf5
 import nbody
 import sph
 import snapshot
+import transport
+import ledger
 
 import visualize
 import analyze
@@ -2,11 +2,91 @@
 # Jacob Hummel
 import numpy
 import pandas
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
 import units
 
 #===============================================================================
 def reject_outliers(data, m=2):
-    return data[numpy.abs(data - numpy.mean(data)) < m * numpy.std(data)]
+    return data[numpy.abs(data - numpy.mean(data)) <= m * numpy.std(data)]
+
+def shrinking_sphere(xyz, mass=None, factor=0.975, npart=100, center=None,
+                     radius=None):
+    """
+    Return the shrinking sphere center of a set of particles, and the
+    particles in the final sphere.  Starting from a sphere of radius
+    around center, the sphere is centered on the center of mass of the
+    particles it contains and its radius reduced by factor, until fewer
+    than npart particles remain.
+    xyz: (N,3) array of positions.
+    mass: particle masses (default: equal masses).
+    center: starting center (default: center of mass of all particles).
+    radius: starting radius (default: enclosing every particle).
+    Each step scans the particles of the previous sphere, over about
+    ln(radius/R_final)/(1-factor) steps, so the cost is not linear in N
+    when the starting sphere is much larger than the region of interest
+    (e.g. zoom simulations with distant low resolution particles): pass a
+    tight center and radius then.
+    """
+    xyz = numpy.asarray(xyz)
+    if mass is None:
+        mass = numpy.ones(xyz.shape[0])
+    mass = numpy.asarray(mass)
+    if center is None:
+        center = numpy.average(xyz, axis=0, weights=mass)
+    center = numpy.asarray(center, dtype=numpy.float64)
+    if radius is None:
+        radius = numpy.sqrt(((xyz - center)**2).sum(axis=1).max())
+        members = numpy.arange(xyz.shape[0])
+    else:
+        members = numpy.flatnonzero(((xyz - center)**2).sum(axis=1)
+                                    <= radius**2)
+        if members.size == 0:
+            raise ValueError('No particles within radius of center')
+        center = numpy.average(xyz[members], axis=0, weights=mass[members])
+    r2 = radius**2
+    while members.size > npart:
+        # The sphere only shrinks, so each step only searches the
+        # particles of the previous one.
+        r2 *= factor**2
+        d2 = ((xyz[members] - center)**2).sum(axis=1)
+        inside = members[d2 <= r2]
+        if inside.size < npart:
+            break
+        members = inside
+        center = numpy.average(xyz[members], axis=0, weights=mass[members])
+    return center, members
+
+def potential_minimum(xyz, mass=None, k=32, chunk_size=2**20):
+    """
+    Return the position of the particle with the lowest local potential,
+    and its nearest neighbours.  The potential of each particle is summed
+    over its k nearest neighbours, found with a KD-tree.
+    xyz: (N,3) array of positions.
+    mass: particle masses (default: equal masses).
+    """
+    xyz = numpy.asarray(xyz)
+    if mass is None:
+        mass = numpy.ones(xyz.shape[0])
+    mass = numpy.asarray(mass)
+    k = min(k + 1, xyz.shape[0])
+    tree = cKDTree(xyz)
+    best = (numpy.inf, None, None)
+    for start in xrange(0, xyz.shape[0], chunk_size):
+        dist, neighbors = tree.query(xyz[start:start+chunk_size], k)
+        # Skip each particle itself (distance 0).
+        dist = numpy.maximum(dist[:,1:], numpy.finfo(dist.dtype).tiny)
+        neighbors = neighbors[:,1:]
+        potential = -(mass[neighbors] / dist).sum(axis=1)
+        i = potential.argmin()
+        if potential[i] < best[0]:
+            best = (potential[i], start + i, neighbors[i])
+    i, neighbors = best[1], best[2]
+    return xyz[i], numpy.concatenate(([i], neighbors))
 
 def find_center(pos_vel, density=None, **kwargs):
     centering = kwargs.pop('centering','box')
@@ -16,16 +96,21 @@ def find_center(pos_vel, density=None, **kwargs):
             dens_limit = kwargs.pop('dens_limit', 1e8)
             nparticles = kwargs.pop('centering_npart', 100)
             if centering == 'avg':
-                hidens = numpy.where(density >= dens_limit)[0]
-                while hidens.size < nparticles:
-                    dens_limit /= 2
-                    hidens = numpy.where(density >= dens_limit)[0]
+                # Average over particles above dens_limit, or over the
+                # nparticles densest if too few are, found in one pass.
+                density = numpy.asarray(density)
+                hidens = numpy.flatnonzero(density >= dens_limit)
+                if hidens.size < nparticles:
+                    nparticles = min(nparticles, density.size)
+                    hidens = numpy.argpartition(density, -nparticles)
+                    hidens = hidens[-nparticles:]
+                    dens_limit = density[hidens].min()
                 if verbose:
                     print ('Center averaged over %d particles' %hidens.size)
                     print ('Center averaged over all particles with density '\
                                'greater than %.2e particles/cc' %dens_limit)
                 #Center on highest density clump, rejecting outliers:
-                center = reject_outliers(pos_vel).mean()
+                center = reject_outliers(pos_vel.iloc[hidens]).mean()
                 print 'Density averaged box center:',
             elif centering == 'max':
                 center = pos_vel.iloc[density.argmax()]
@@ -39,8 +124,42 @@ def find_center(pos_vel, density=None, **kwargs):
         except ValueError:
             pass
         print 'Simple box center:',
+    elif centering in ['shrink', 'potential']:
+        mass = kwargs.pop('mass', None)
+        xyz = pos_vel[['x', 'y', 'z']].values
+        if centering == 'shrink':
+            # Start from the sphere around shrink_center (default: median
+            # position) holding shrink_percentile percent of the particles,
+            # rather than from all of them, which takes many passes over
+            # nearly every particle when a few lie far away.
+            start = kwargs.pop('shrink_center', None)
+            if start is None:
+                start = numpy.median(xyz, axis=0)
+            radius = kwargs.pop('shrink_radius', None)
+            if radius is None:
+                radius = numpy.percentile(
+                    numpy.sqrt(((xyz - start)**2).sum(axis=1)),
+                    kwargs.pop('shrink_percentile', 50))
+            xyz_center, members = shrinking_sphere(xyz, mass,
+                                   kwargs.pop('shrink_factor', 0.975),
+                                   kwargs.pop('centering_npart', 100),
+                                   start, radius)
+            print 'Shrinking sphere center:',
+        else:
+            # Neighbours summed per particle, unrelated to the
+            # shrinking sphere's centering_npart.
+            xyz_center, members = potential_minimum(xyz, mass,
+                                   kwargs.pop('potential_k', 32))
+            print 'Potential minimum center:',
+        # Velocity center from the particles around the center.
+        if mass is not None:
+            mass = numpy.asarray(mass)[members]
+        center = numpy.average(pos_vel.values[members], axis=0, weights=mass)
+        center = pandas.Series(center, index=pos_vel.columns)
+        center[['x', 'y', 'z']] = xyz_center
     else:
-        raise KeyError("Centering options are 'avg', 'max', and 'box'")
+        raise KeyError("Centering options are 'avg', 'max', 'box', "\
+                       "'shrink' and 'potential'")
     print '%.3e %.3e %.3e' %(center.x, center.y, center.z)
     return center
 
@@ -61,7 +180,8 @@ def center_box(pos_vel, center=None, vcenter=None, **kwargs):
         print "WARNING! NO CENTER OR CENTERING ALGORITHM SPECIFIED!"
         print "Attempting simple box centering..."
         center = find_center(pos_vel, density, **kwargs)
-    pos_vel -= center
+    # Keep the precision of the particle data.
+    pos_vel -= center.astype(numpy.result_type(*pos_vel.dtypes))
     return pos_vel
 
 def angular_momentum(xyz, uvw, mass):
@@ -101,3 +221,335 @@ def faceon_rotation(xyz, uvw, mass=None):
     axis = numpy.cross(z, unitL)
     angle = numpy.arccos(unitL.dot(z))
     return axis, angle
+
+def radial_profile(r, mass=None, bins=50, scale='log', rmin=None, rmax=None,
+                   min_particles=32, **fields):
+    """
+    Return a DataFrame of spherically averaged properties in radial shells,
+    computed in a single binning pass over the particles.
+    r: particle radii.
+    mass: particle masses (default: equal masses).
+    bins: number of bins, or array of bin edges.
+    scale: 'log' or 'linear' bin spacing between rmin and rmax (default:
+           the smallest nonzero and the largest radius).
+    min_particles: shells with fewer particles are merged outwards with
+                   the next ones.
+    fields: per-particle quantities (e.g. temp=..., vr=...) for which the
+            mass-weighted mean and dispersion in each shell are returned as
+            columns 'name' and 'name_sigma'.
+    Columns: r_in, r_out, npart, Mshell, Menc, rho_shell, rho_enc, fields.
+    """
+    r = numpy.asarray(r, dtype=numpy.float64)
+    if mass is None:
+        mass = numpy.ones(r.size)
+    mass = numpy.asarray(mass, dtype=numpy.float64)
+    if numpy.ndim(bins) == 0:
+        if rmin is None:
+            rmin = r[r > 0].min()
+        if rmax is None:
+            rmax = r.max()
+        if scale == 'log':
+            edges = numpy.logspace(numpy.log10(rmin), numpy.log10(rmax),
+                                   bins + 1)
+        elif scale == 'linear':
+            edges = numpy.linspace(rmin, rmax, bins + 1)
+        else:
+            raise KeyError("scale options: 'log' 'linear'")
+    else:
+        edges = numpy.asarray(bins, dtype=numpy.float64)
+    nbins = edges.size - 1
+
+    # Shell index of each particle: -1 inside the first edge, nbins outside
+    # the last one.
+    shell = numpy.searchsorted(edges, r, 'left') - 1
+    shell[r == edges[0]] = 0
+    inside = shell < 0
+    shell = numpy.where(inside, nbins, shell)
+    sums = {'npart':numpy.bincount(shell, minlength=nbins+1)[:nbins],
+            'Mshell':numpy.bincount(shell, mass, nbins+1)[:nbins]}
+    for name, values in fields.items():
+        values = numpy.asarray(values, dtype=numpy.float64)
+        sums[name] = numpy.bincount(shell, mass*values, nbins+1)[:nbins]
+        sums[name+'2'] = numpy.bincount(shell, mass*values**2, nbins+1)[:nbins]
+
+    # Merge shells with too few particles outwards.
+    groups = []
+    start = 0
+    count = 0
+    for i in xrange(nbins):
+        count += sums['npart'][i]
+        if count >= min_particles:
+            groups.append((start, i + 1))
+            start = i + 1
+            count = 0
+    if start < nbins:
+        if groups:
+            groups[-1] = (groups[-1][0], nbins)
+        else:
+            groups.append((0, nbins))
+    cuts = numpy.array([g[0] for g in groups])
+    merged = dict((key, numpy.add.reduceat(value, cuts))
+                  for key, value in sums.items())
+
+    profile = pandas.DataFrame({'r_in':edges[cuts],
+                                'r_out':edges[[g[1] for g in groups]]})
+    profile['npart'] = merged['npart']
+    profile['Mshell'] = merged['Mshell']
+    profile['Menc'] = mass[inside].sum() + merged['Mshell'].cumsum()
+    volume = 4 * numpy.pi / 3 * profile.r_out**3
+    profile['rho_shell'] = profile.Mshell \
+                           / (volume - 4 * numpy.pi / 3 * profile.r_in**3)
+    profile['rho_enc'] = profile.Menc / volume
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for name in fields:
+            mean = merged[name] / merged['Mshell']
+            var = merged[name+'2'] / merged['Mshell'] - mean**2
+            profile[name] = mean
+            profile[name+'_sigma'] = numpy.sqrt(numpy.maximum(var, 0))
+    return profile
+
+def virial_radius(pos, mass, center, redshift, delta=178, **kwargs):
+    """
+    Return the virial radius and mass of a halo, with its maximum circular
+    velocity and the concentration proxy V_max/V_vir, in cgs units.
+    pos: (N,3) particle positions in cm, or a list of such arrays (e.g.
+         gas and dark matter), which are not concatenated.
+    mass: particle masses in g, or a list matching pos.
+    center: halo center in cm.
+    delta: overdensity of the mean enclosed density: a number (relative to
+           the mean matter density), '200c' or '200m' (relative to the
+           critical or mean matter density), or 'vir' (Bryan & Norman 1998).
+    header: snapshot header (e.g. snap.header) to take the cosmology from.
+    omega_m, omega_l, hubble: cosmological parameters, overriding header.
+        Pass them or header: the fallback (0.27, 0.73, 0.7) is unlikely to
+        match the simulation.
+    min_particles (100): ignore radii enclosing fewer particles.
+    """
+    GRAVITY = 6.6726e-8 # dyne * cm**2 / g**2
+    header = kwargs.pop('header', None)
+    if header is not None:
+        cosmology = (header.Omega0, header.OmegaLambda, header.HubbleParam)
+    else:
+        cosmology = (0.27, 0.73, 0.7)
+    omega_m = kwargs.pop('omega_m', cosmology[0])
+    omega_l = kwargs.pop('omega_l', cosmology[1])
+    hubble = kwargs.pop('hubble', cosmology[2])
+    min_particles = kwargs.pop('min_particles', 100)
+
+    a3 = (1 + redshift)**3
+    H2 = (hubble * 3.2407789e-18)**2 * (omega_m * a3 + omega_l)
+    rho_crit = 3 * H2 / (8 * numpy.pi * GRAVITY)
+    rho_mean = omega_m * a3 * (hubble * 3.2407789e-18)**2 \
+               * 3 / (8 * numpy.pi * GRAVITY)
+    if delta == 'vir':
+        x = omega_m * a3 / (omega_m * a3 + omega_l) - 1
+        threshold = (18 * numpy.pi**2 + 82 * x - 39 * x**2) * rho_crit
+    elif isinstance(delta, basestring) and delta[-1] in ['c', 'm']:
+        rho = rho_crit if delta[-1] == 'c' else rho_mean
+        threshold = float(delta[:-1]) * rho
+    elif not isinstance(delta, basestring):
+        threshold = delta * rho_mean
+    else:
+        raise KeyError("delta options: number, 'NNNc', 'NNNm', 'vir'")
+
+    if not isinstance(pos, (list, tuple)):
+        pos = [pos]
+        mass = [mass]
+    center = numpy.asarray(center, dtype=numpy.float64)
+    # Sort each component by radius once.
+    components = []
+    for xyz, m in zip(pos, mass):
+        r = numpy.sqrt(((numpy.asarray(xyz) - center)**2).sum(axis=1))
+        if r.size == 0:
+            continue
+        order = r.argsort()
+        components.append((r[order],
+                           numpy.asarray(m, dtype=numpy.float64)[order].cumsum()))
+
+    # Enclosed mass at every particle radius, adding the cumulative mass of
+    # the other components at that radius.
+    radii = []
+    enclosed = []
+    for k, (r, cmass) in enumerate(components):
+        menc = cmass.copy()
+        nenc = numpy.arange(1, r.size + 1)
+        for j, (rj, cmj) in enumerate(components):
+            if j != k:
+                i = numpy.searchsorted(rj, r, 'right')
+                menc += numpy.where(i > 0, cmj[i-1], 0)
+                nenc += i
+        valid = nenc >= min_particles
+        radii.append(r[valid])
+        enclosed.append(menc[valid])
+
+    result = pandas.Series(numpy.nan, index=['R_vir', 'M_vir', 'V_vir',
+                                             'V_max', 'R_max', 'concentration'])
+    # First radius where the mean enclosed density falls below threshold.
+    crossing = numpy.inf
+    for r, menc in zip(radii, enclosed):
+        below = numpy.flatnonzero(menc < threshold * 4 * numpy.pi / 3 * r**3)
+        if below.size:
+            crossing = min(crossing, r[below[0]])
+    if not numpy.isfinite(crossing):
+        print 'Warning: mean enclosed density never falls below threshold.'
+        return result
+    R_vir = 0
+    for r, menc in zip(radii, enclosed):
+        i = numpy.searchsorted(r, crossing, 'left')
+        if i > 0 and r[i-1] > R_vir:
+            R_vir = r[i-1]
+            M_vir = menc[i-1]
+    if R_vir == 0:
+        return result
+    V_max = 0
+    for r, menc in zip(radii, enclosed):
+        i = numpy.searchsorted(r, R_vir, 'right')
+        if i > 0:
+            vcirc = numpy.sqrt(GRAVITY * menc[:i] / r[:i])
+            imax = vcirc.argmax()
+            if vcirc[imax] > V_max:
+                V_max = vcirc[imax]
+                R_max = r[imax]
+    V_vir = numpy.sqrt(GRAVITY * M_vir / R_vir)
+    result[:] = [R_vir, M_vir, V_vir, V_max, R_max, V_max / V_vir]
+    return result
+
+def _chunk_links(tree, xyz, rows, linking_length):
+    """
+    Return the pairs (i, j), i < j, of particles rows linked to particles
+    in tree.
+    """
+    chunk = cKDTree(xyz[rows], boxsize=tree.boxsize)
+    pairs = chunk.sparse_distance_matrix(tree, linking_length,
+                                         output_type='ndarray')
+    i = rows[pairs['i']]
+    j = pairs['j']
+    later = i < j
+    return i[later], j[later]
+
+def _find_roots(parent, nodes):
+    """
+    Return the roots of nodes in the union-find forest parent, pointing
+    every node on the way straight at its root.
+    """
+    path = [nodes]
+    roots = parent[nodes]
+    while True:
+        up = parent[roots]
+        if numpy.array_equal(up, roots):
+            break
+        path.append(roots)
+        roots = up
+    for nodes in path:
+        parent[nodes] = roots
+    return roots
+
+def _link(parent, i, j):
+    """
+    Merge the components of each pair of nodes i, j in the union-find
+    forest parent, under the lowest root of each.
+    """
+    ri = _find_roots(parent, i)
+    rj = _find_roots(parent, j)
+    apart = ri != rj
+    if not apart.any():
+        return
+    n = apart.sum()
+    roots, inverse = numpy.unique(numpy.concatenate((ri[apart], rj[apart])),
+                                  return_inverse=True)
+    graph = coo_matrix((numpy.ones(n, dtype=numpy.int8),
+                        (inverse[:n], inverse[n:])),
+                       shape=(roots.size, roots.size))
+    ncomp, labels = connected_components(graph, directed=False)
+    # roots are sorted, so the first of each component is its lowest.
+    first = numpy.empty(ncomp, dtype=numpy.int64)
+    first[labels[::-1]] = numpy.arange(roots.size)[::-1]
+    parent[roots] = roots[first[labels]]
+
+def friends_of_friends(xyz, b=0.2, mass=None, boxsize=None, **kwargs):
+    """
+    Find friends-of-friends groups: particles closer than the linking
+    length b times the mean interparticle spacing belong to the same group.
+    xyz: (N,3) particle positions.
+    mass: particle masses (default: equal masses).
+    boxsize: if set, the box is periodic with this size (positions are
+             wrapped into it).
+    linking_length: absolute linking length, overriding b.
+    spacing: mean interparticle spacing (default: from the box volume, or
+             the volume of the particles' bounding box, and N).
+    min_members (20): smallest group size returned.
+    threads: number of threads (default: one per core).
+    chunk_size (2**16): particles linked at a time per thread.
+    The particles are taken in chunks along x, each linked against a
+    KD-tree of all particles in a separate thread.  The links of each chunk
+    are merged into a union-find forest as soon as they are found, so only
+    the links of one chunk per thread are held at a time.
+    Returns a catalog DataFrame (offset, npart, mass and center of mass
+    x, y, z per group, largest first) and the array of member row
+    positions, group by group: members[offset:offset+npart].
+    """
+    min_members = kwargs.pop('min_members', 20)
+    threads = kwargs.pop('threads', None) or mp.cpu_count()
+    chunk_size = kwargs.pop('chunk_size', 2**16)
+    xyz = numpy.asarray(xyz, dtype=numpy.float64)
+    N = xyz.shape[0]
+    if mass is None:
+        mass = numpy.ones(N)
+    mass = numpy.asarray(mass, dtype=numpy.float64)
+    if boxsize is not None:
+        xyz = numpy.mod(xyz, boxsize)
+        volume = float(boxsize)**3
+    else:
+        volume = numpy.prod(xyz.max(axis=0) - xyz.min(axis=0))
+    spacing = kwargs.pop('spacing', (volume / N)**(1./3))
+    linking_length = kwargs.pop('linking_length', b * spacing)
+
+    tree = cKDTree(xyz, boxsize=boxsize)
+    parent = numpy.arange(N)
+    order = xyz[:,0].argsort()
+    chunks = [numpy.sort(order[start:start+chunk_size])
+              for start in xrange(0, N, chunk_size)]
+    pool = ThreadPool(threads)
+    try:
+        for start in xrange(0, len(chunks), threads):
+            links = pool.map(lambda rows: _chunk_links(tree, xyz, rows,
+                                                       linking_length),
+                             chunks[start:start+threads])
+            for i, j in links:
+                _link(parent, i, j)
+    finally:
+        pool.close()
+    roots = _find_roots(parent, numpy.arange(N))
+    roots, labels = numpy.unique(roots, return_inverse=True)
+    ngroups = roots.size
+
+    npart = numpy.bincount(labels, minlength=ngroups)
+    groups = numpy.flatnonzero(npart >= min_members)
+    groups = groups[numpy.argsort(-npart[groups], kind='mergesort')]
+    rank = numpy.full(ngroups, -1, dtype=numpy.int64)
+    rank[groups] = numpy.arange(groups.size)
+    member_rank = rank[labels]
+    members = numpy.flatnonzero(member_rank >= 0)
+    members = members[numpy.argsort(member_rank[members], kind='mergesort')]
+    member_rank = member_rank[members]
+
+    catalog = pandas.DataFrame({'npart':npart[groups]})
+    catalog['offset'] = numpy.concatenate(([0], catalog.npart.cumsum()[:-1]))
+    gmass = numpy.bincount(member_rank, mass[members], groups.size)
+    catalog['mass'] = gmass
+    # Center of mass relative to the first member, so periodic groups
+    # straddling the box edge are handled.
+    reference = xyz[members[catalog.offset.values]]
+    for axis, name in enumerate(['x', 'y', 'z']):
+        dx = xyz[members, axis] - reference[member_rank, axis]
+        if boxsize is not None:
+            dx = (dx + boxsize/2.) % boxsize - boxsize/2.
+        com = reference[:,axis] \
+              + numpy.bincount(member_rank, mass[members]*dx, groups.size) \
+              / gmass
+        if boxsize is not None:
+            com %= boxsize
+        catalog[name] = com
+    catalog = catalog[['offset', 'npart', 'mass', 'x', 'y', 'z']]
+    catalog.index.name = 'group'
+    return catalog, members
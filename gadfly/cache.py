@@ -0,0 +1,105 @@
+# cache.py
+"""
+This module contains an on-disk cache for converted particle data.
+"""
+import os
+import hashlib
+import tempfile
+import numpy
+
+class FieldCache(object):
+    """
+    Cache of converted particle fields, stored as .npy files that are
+    memory-mapped when read back.  The least recently used entries are
+    evicted once the cache grows beyond max_bytes (None: no limit).
+    """
+    def __init__(self, path, max_bytes=10*2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, *parts):
+        """
+        Return a cache key for a sequence of identifying values.
+        """
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """
+        Return a read-only memory map of the array stored under key, or
+        None if it is not cached.
+        """
+        fname = self._file(key)
+        try:
+            values = numpy.load(fname, mmap_mode='r')
+        except IOError:
+            return None
+        # Mark as recently used.
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return values
+
+    def put(self, key, values):
+        """
+        Store an array under key, then evict old entries if over budget.
+        """
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, numpy.ascontiguousarray(values))
+            os.rename(tmp, self._file(key))
+        except (IOError, OSError):
+            print 'Warning: could not write to field cache', self.path
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache fits in
+        max_bytes (default: the cache size limit, if any).
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        evict(self.path, max_bytes)
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        self.evict(0)
+
+def evict(path, max_bytes, suffix='.npy'):
+    """
+    Remove the least recently used (by mtime) files ending in suffix from
+    directory path until they fit in max_bytes (None: no limit).
+    """
+    if max_bytes is None:
+        return
+    entries = []
+    for fname in os.listdir(path):
+        if not fname.endswith(suffix):
+            continue
+        fname = os.path.join(path, fname)
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fname))
+    total = sum(entry[1] for entry in entries)
+    entries.sort()
+    for mtime, size, fname in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+        total -= size
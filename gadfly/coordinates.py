@@ -106,6 +106,8 @@ def rotation_matrix(axis, angle):
 
 def rotate(coords, axis, angle, verbose=False):
     rot = rotation_matrix(axis,angle)
+    # Rotate in the precision of the coordinates.
+    rot = rot.astype(np.result_type(*coords.dtypes))
     if verbose:
         print "Rotating about the {}-axis by {:6.3f} radians.".format(axis,angle)
         print "Rotation Matrix:"
@@ -3,14 +3,197 @@
 """
 This module contains classes for reading Gadget2 HDF5 snapshot data.
 """
+import os
+import shutil
+import hashlib
 import numpy
+import h5py
+import multiprocessing as mp
 from pandas import Series, DataFrame
 
 import units
+import cache
+import transport
 import coordinates
 import analyze
 import visualize
-        
+
+# Number of particles read from a dataset at a time by chunked readers.
+CHUNK_SIZE = 2**20
+
+def read_rows(dataset, rows, chunk_size=CHUNK_SIZE):
+    """
+    Read selected rows of an h5py dataset without reading the whole thing.
+    rows: sorted array of row positions.
+    Rows falling in the same chunk_size block of the dataset are read with
+    a single hyperslab spanning them, or with a point selection if they
+    are sparse within it.
+    """
+    rows = numpy.asarray(rows)
+    data = numpy.empty((rows.size,) + dataset.shape[1:], dtype=dataset.dtype)
+    if rows.size == 0:
+        return data
+    breaks = numpy.flatnonzero(numpy.diff(rows // chunk_size)) + 1
+    edges = numpy.concatenate(([0], breaks, [rows.size]))
+    for i0, i1 in zip(edges[:-1], edges[1:]):
+        lo = rows[i0]
+        hi = rows[i1-1] + 1
+        if (i1 - i0) * 64 < hi - lo:
+            data[i0:i1] = dataset[list(rows[i0:i1])]
+        else:
+            data[i0:i1] = dataset[lo:hi][rows[i0:i1] - lo]
+    return data
+
+class MultiFileDataset(object):
+    """
+    A dataset split across the files of a multi-file snapshot, presented
+    as a single h5py-like dataset.  Reads spanning several files fill a
+    preallocated array directly, one file after another.
+    """
+    def __init__(self, datasets, counts):
+        self._datasets = datasets
+        # NumPart_ThisFile may be unsigned; keep offsets integral.
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        self._offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+        self.shape = (int(self._offsets[-1]),) + datasets[0].shape[1:]
+        self.dtype = datasets[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def name(self):
+        return self._datasets[0].name
+
+    @property
+    def value(self):
+        return self[:]
+
+    def _gather(self, data, reads):
+        """
+        Fill data from a list of (file index, source selection,
+        destination selection) reads.  h5py serializes calls into the HDF5
+        library, so the reads are issued in turn.
+        """
+        for i, source, dest in reads:
+            if isinstance(source, slice):
+                self._datasets[i].read_direct(data, source, dest)
+            else:
+                data[dest] = self._datasets[i][source]
+        return data
+
+    def __getitem__(self, key):
+        if key == ():
+            key = slice(None)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step != 1:
+                return self[start:stop][::step]
+            data = numpy.empty((max(stop - start, 0),) + self.shape[1:],
+                               dtype=self.dtype)
+            reads = []
+            for i, dataset in enumerate(self._datasets):
+                lo = max(start, self._offsets[i])
+                hi = min(stop, self._offsets[i+1])
+                if hi > lo:
+                    source = numpy.s_[lo-self._offsets[i]:hi-self._offsets[i]]
+                    reads.append((i, source, numpy.s_[lo-start:hi-start]))
+            return self._gather(data, reads)
+        # Sorted point selection.
+        rows = numpy.asarray(key)
+        data = numpy.empty((rows.size,) + self.shape[1:], dtype=self.dtype)
+        files = numpy.searchsorted(self._offsets, rows, 'right') - 1
+        reads = []
+        for i in numpy.unique(files):
+            dest = numpy.flatnonzero(files == i)
+            reads.append((i, list(rows[dest] - self._offsets[i]), dest))
+        return self._gather(data, reads)
+
+def _read_dataset(args):
+    """
+    Reader process for PartType.prefetch: open the snapshot afresh, read
+    the selected rows of a dataset and hand them over through shared_dir.
+    """
+    import snapshot
+    filename, options, name, rows, shared_dir = args
+    group, key = name.strip('/').split('/', 1)
+    file_id = snapshot.open_hdf5(filename, **options)
+    try:
+        dataset = file_id[group][key]
+        if rows is None:
+            values = dataset[:]
+        else:
+            values = read_rows(dataset, rows)
+    finally:
+        file_id.close()
+    return transport.dump(values, shared_dir)
+
+class MultiFileGroup(object):
+    """
+    A PartType group split across the files of a multi-file snapshot.
+    """
+    def __init__(self, groups, counts):
+        self._groups = groups
+        self._counts = counts
+
+    def keys(self):
+        return self._groups[0].keys()
+
+    def items(self):
+        return [(key, MultiFileDataset([g[key] for g in self._groups],
+                                       self._counts))
+                for key in self.keys()]
+
+    def __getitem__(self, key):
+        return MultiFileDataset([g[key] for g in self._groups],
+                                self._counts)
+
+class MultiFile(object):
+    """
+    The open files of a snapshot written in NumFilesPerSnapshot pieces,
+    presented as a single h5py-like file.
+    """
+    def __init__(self, file_ids):
+        self.file_ids = file_ids
+        header = file_ids[0]['Header'].attrs
+        self._total = numpy.array(header['NumPart_Total'], dtype=numpy.int64)
+        if 'NumPart_Total_HighWord' in header:
+            highword = numpy.array(header['NumPart_Total_HighWord'],
+                                   dtype=numpy.int64)
+            self._total += highword << 32
+
+    @property
+    def filename(self):
+        return self.file_ids[0].filename
+
+    def keys(self):
+        keys = []
+        for file_id in self.file_ids:
+            keys += [key for key in file_id.keys() if key not in keys]
+        return keys
+
+    def __getitem__(self, key):
+        if not key.startswith('PartType'):
+            return self.file_ids[0][key]
+        ptype = int(key[len('PartType'):])
+        groups = []
+        counts = []
+        for file_id in self.file_ids:
+            n = file_id['Header'].attrs['NumPart_ThisFile'][ptype]
+            if n > 0:
+                groups.append(file_id[key])
+                counts.append(n)
+        if not groups:
+            raise KeyError(key)
+        if sum(counts) != self._total[ptype]:
+            raise IOError('NumPart_ThisFile does not sum to NumPart_Total '
+                          'for ' + key)
+        return MultiFileGroup(groups, counts)
+
+    def close(self):
+        for file_id in self.file_ids:
+            file_id.close()
+
 class Header(object):
     """
     Class for header information from Gadget2 HDF5 snapshots.
@@ -38,6 +221,10 @@ class PartType(DataFrame):
     """
     Class for generic particle info.
     """
+    # Columns vector datasets are stored under.
+    _vector_columns = {'coordinates':['x', 'y', 'z'],
+                       'velocities':['u', 'v', 'w']}
+
     def __init__(self, file_id, ptype, sim, **kwargs):
         group = file_id['PartType'+str(ptype)]
         for item in group.items():
@@ -47,18 +234,50 @@ class PartType(DataFrame):
             else:
                 key = '_'+item[0].replace(' ', '_')
                 vars(self)[key] = item[1]
-        super(PartType, self).__init__(index=self._particleIDs.value)
-        self._drop_ids = None
+        lazy = kwargs.pop('lazy_load', sim.lazy_load)
+        if lazy:
+            super(PartType, self).__init__()
+        else:
+            super(PartType, self).__init__(index=self._particleIDs.value)
+        self._indexed = not lazy
+        self._rows = None
+        self._rows_key = None
+        self._filename = file_id.filename
+        # Every piece of a multi-file snapshot, for cache keys.
+        self._filenames = [f.filename for f in
+                           getattr(file_id, 'file_ids', [file_id])]
+        self._hdf5_options = sim.hdf5_options
+        self._group = 'PartType'+str(ptype)
         self._header = Header(file_id)
         self.units = sim.units
+        self._loaded_units = {}
+        # Vector fields moved by orient_box, which can't be rescaled.
+        self._reoriented = set()
+        self._raw = {}
+        self._prefetched = {}
+        self._cache_raw = sim.cache_raw
+        self._dtype = kwargs.pop('dtype', sim.dtype)
+        self._field_cache = sim.field_cache
+        self._id_index = None
+        self._id_index_path = sim.id_index_path
+        self._spatial_index = None
+        # Bumped whenever x, y, z change, to tell if the tree is current.
+        self._coords_version = 0
+        self._spatial_index_path = sim.spatial_index_path
+        self._spatial_index_size = sim.spatial_index_size
         self.__init_load_dict__()
 
     def __getstate__(self):
-        result = self.__dict__.copy()
-        del result['_coordinates']
-        del result['_particleIDs']
-        del result['_velocities']
-        del result['_masses']
+        # Open datasets can't be pickled; drop every one of them, whatever
+        # fields the subclass reads.
+        result = {}
+        for key, value in self.__dict__.iteritems():
+            if not isinstance(value, (h5py.Dataset, MultiFileDataset)):
+                result[key] = value
+        result['_raw'] = {}
+        result['_prefetched'] = {}
+        result['_id_index'] = None
+        result['_spatial_index'] = None
         return result
 
     def __setstate__(self, in_dict):
@@ -69,21 +288,319 @@ class PartType(DataFrame):
         self._load_dict = {'particleIDs':self.load_PIDs}
         self.loadable_keys = self._load_dict.keys()
 
+    def build_index(self):
+        """
+        Index the DataFrame by Particle ID numbers.  When the PartType was
+        opened with lazy_load, particles are indexed by position until
+        their IDs are loaded (load_PIDs, get_PIDs or load_data).
+        """
+        if self._indexed:
+            return
+        particleIDs = self._read('particleIDs')
+        if 'particleIDs' not in self.columns:
+            self['particleIDs'] = particleIDs
+        self.index = particleIDs
+        self._indexed = True
+
+    def _get_id_index(self):
+        """
+        Return the particle IDs of every particle in the file in sorted
+        order, and their row positions.  Both are saved in the ID index
+        directory and memory-mapped, so they are only computed once per
+        snapshot file.
+        """
+        if self._id_index is not None:
+            return self._id_index
+        index_cache = None
+        if self._id_index_path is not None:
+            try:
+                index_cache = cache.FieldCache(self._id_index_path, None)
+            except OSError:
+                print 'Warning: could not create ID index', self._id_index_path
+        if index_cache is not None:
+            key = index_cache.key(os.path.abspath(self._filename),
+                                  self._stamp(), self._group)
+            ids = index_cache.get(key + '-ids')
+            order = index_cache.get(key + '-order')
+        if index_cache is None or ids is None or order is None:
+            ids = self._particleIDs[:]
+            order = ids.argsort(kind='mergesort')
+            if order.size < 2**31:
+                order = order.astype(numpy.int32)
+            ids = ids[order]
+            if index_cache is not None:
+                index_cache.put(key + '-ids', ids)
+                index_cache.put(key + '-order', order)
+        self._id_index = (ids, order)
+        return self._id_index
+
+    def positions_of(self, ids):
+        """
+        Return the row positions in the HDF5 file of particles with the
+        given IDs, or -1 for IDs not found.
+        ids: array of particle ID numbers.
+        """
+        ids = numpy.asarray(ids)
+        sorted_ids, order = self._get_id_index()
+        if sorted_ids.size == 0:
+            return numpy.full(ids.shape, -1, dtype=numpy.int64)
+        i = numpy.searchsorted(sorted_ids, ids)
+        i = numpy.minimum(i, sorted_ids.size - 1)
+        found = sorted_ids[i] == ids
+        return numpy.where(found, order[i], -1).astype(numpy.int64)
+
+    def select_ids(self, ids):
+        """
+        Restrict the particle selection to the given particle IDs (those
+        already selected and present in the file).  Subsequent loads only
+        read the rows of these particles.
+        """
+        rows = self.positions_of(ids)
+        rows = numpy.unique(rows[rows >= 0])
+        if self._rows is None:
+            keep = numpy.zeros(self._particleIDs.shape[0], dtype=bool)
+            keep[rows] = True
+        else:
+            keep = numpy.in1d(self._rows, rows, assume_unique=True)
+        self.select_rows(keep)
+
     def refine_dataset(self, criterion):
-        self._drop_ids = self[criterion].index
-        self.drop(self._drop_ids, inplace=True)
+        """
+        Drop particles from the dataset.
+        criterion: boolean Series or array, True for particles to drop.
+        The selection is kept as row positions, so later loads read only
+        the remaining particles from the HDF5 file.
+        """
+        self.select_rows(~numpy.asarray(criterion, dtype=bool))
         print self.index.size, 'particles selected.'
 
-    def load_PIDs(self):
+    def _store(self, values, *keys):
         """
-        Load Particle ID numbers
+        Store freshly loaded values for the selected particles under key(s).
         """
-        particleIDs = self._particleIDs.value
-        if self._drop_ids is not None:
-            particleIDs = Series(particleIDs, index=self._particleIDs.value)
-            self['particleIDs'] = particleIDs.drop(self._drop_ids)
+        if self.index.size:
+            index = self.index
         else:
-            self['particleIDs'] = particleIDs
+            index = None
+        if len(keys) > 1:
+            values = DataFrame(values, index=index, columns=keys)
+        else:
+            values = Series(values, index=index)
+        if len(keys) > 1:
+            for key in keys:
+                self[key] = values[key]
+        else:
+            self[keys[0]] = values
+
+    def _read(self, key):
+        """
+        Read the HDF5 dataset for key, restricted to the selected particles.
+        """
+        values = self._prefetched.pop(key, None)
+        if values is not None:
+            return values
+        dataset = vars(self)['_'+key]
+        if self._rows is None:
+            return dataset.value
+        return read_rows(dataset, self._rows)
+
+    def _conversion(self, key, unit=None):
+        """
+        Return the factor converting dataset key from code units to unit,
+        or None if the dataset is used as stored.
+        """
+        return None
+
+    def _raw_values(self, key):
+        """
+        Return dataset key for the selected particles in code units.  The
+        dataset is only read from the HDF5 file the first time; loads in
+        other units rescale the stored copy.
+        """
+        try:
+            return self._raw[key]
+        except KeyError:
+            values = self._read(key)
+            if self._cache_raw:
+                self._raw[key] = values
+            return values
+
+    def _apply_conversion(self, values, conv):
+        """
+        Return values multiplied by conv, following the dtype policy for
+        floating point data: 'native' keeps the precision the data is
+        stored with, 'float32' or 'float64' force it.  Values too large
+        to represent in float32 (e.g. masses in grams) stay float64.
+        """
+        if values.dtype.kind != 'f':
+            return values if conv is None else values * conv
+        if self._dtype == 'native':
+            dtype = values.dtype
+        else:
+            dtype = numpy.dtype(self._dtype)
+        if conv is None:
+            return values.astype(dtype, copy=False)
+        if dtype.itemsize < 8 and values.size:
+            largest = max(values.max(), -values.min())
+            if largest * abs(conv) > numpy.finfo(dtype).max:
+                dtype = numpy.dtype(numpy.float64)
+        converted = values.astype(dtype)
+        converted *= dtype.type(conv)
+        return converted
+
+    def _stamp(self):
+        """
+        Return the size and modification time of every piece of the
+        snapshot file, so that rewriting any of them invalidates what was
+        cached from it.
+        """
+        result = []
+        for fname in self._filenames:
+            stat = os.stat(fname)
+            result.append((os.path.basename(fname), stat.st_size,
+                           stat.st_mtime))
+        return tuple(result)
+
+    def _cache_key(self, key, conv):
+        """
+        Return the field cache key for dataset key loaded with conversion
+        factor conv for the selected particles.
+        """
+        if self._rows_key is None:
+            if self._rows is None:
+                self._rows_key = 'all'
+            else:
+                self._rows_key = hashlib.sha1(self._rows).hexdigest()
+        return self._field_cache.key(os.path.abspath(self._filename),
+                                     self._stamp(),
+                                     self._group, key, repr(conv),
+                                     self.units.coordinate_system,
+                                     self.units.remove_h, self._dtype,
+                                     self._rows_key)
+
+    def _converted(self, key, unit=None):
+        """
+        Return dataset key for the selected particles, converted from code
+        units to unit (default set in units class).  With a field cache,
+        converted values are memory-mapped from the cache instead of being
+        re-read and re-converted.  A field already loaded in another unit
+        is rescaled rather than read again, unless it was centered or
+        rotated since.
+        """
+        conv = self._conversion(key, unit)
+        if self._field_cache is not None:
+            cache_key = self._cache_key(key, conv)
+            values = self._field_cache.get(cache_key)
+            if values is not None:
+                return values
+        columns = self._vector_columns.get(key, [key])
+        if (key not in self._raw and key in self._loaded_units
+            and key not in self._reoriented
+            and all(column in self.columns for column in columns)):
+            loaded = self._conversion(key, self._loaded_units[key])
+            if conv is not None and loaded is not None:
+                if len(columns) > 1:
+                    values = self[columns].values
+                else:
+                    values = self[key].values
+                return self._apply_conversion(values, conv/loaded)
+        values = self._apply_conversion(self._raw_values(key), conv)
+        if self._field_cache is not None:
+            self._field_cache.put(cache_key, values)
+        return values
+
+    def prefetch(self, keys, processes=None):
+        """
+        Read the selected rows of several datasets concurrently, so that
+        the next loads of keys take them ready-made.  h5py serializes reads
+        within a process, so each dataset is read by a separate process
+        with its own file handle, and handed back through shared memory.
+        Worth it when reads are latency bound, e.g. on parallel file
+        systems.
+        keys: dataset keys, e.g. ['coordinates', 'density'].
+        processes: number of reader processes (default: one per core).
+        """
+        keys = [key.replace(' ', '_') for key in keys]
+        keys = [key for key in keys if '_'+key in vars(self)
+                and key != 'particleIDs' and key not in self._raw
+                and key not in self._prefetched]
+        if not keys:
+            return
+        shared_dir = transport.shared_directory()
+        jobs = [(self._filename, self._hdf5_options, vars(self)['_'+key].name,
+                 self._rows, shared_dir) for key in keys]
+        pool = mp.Pool(min(len(keys), processes or mp.cpu_count()))
+        try:
+            payloads = pool.map(_read_dataset, jobs)
+            for key, payload in zip(keys, payloads):
+                self._prefetched[key] = transport.load(payload)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+    def iter_chunks(self, keys, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over the selected particles chunk_size at a time, without
+        loading whole datasets into the DataFrame.  Yields a dict of numpy
+        arrays, converted from code units exactly as the load functions do.
+        keys: dataset keys, e.g. ['masses', 'coordinates', 'density'].
+        chunk_size: maximum number of particles per chunk.
+        """
+        if isinstance(keys, basestring):
+            keys = [keys]
+        datasets = [vars(self)['_'+key.replace(' ', '_')] for key in keys]
+        conversions = [self._conversion(key) for key in keys]
+        if self._rows is None:
+            nrows = self._particleIDs.shape[0]
+        else:
+            nrows = self._rows.size
+        for start in xrange(0, nrows, chunk_size):
+            stop = min(start + chunk_size, nrows)
+            if self._rows is None:
+                rows = slice(start, stop)
+                read = lambda dataset: dataset[rows]
+            else:
+                rows = self._rows[start:stop]
+                read = lambda dataset: read_rows(dataset, rows)
+            chunk = {}
+            for key, dataset, conv in zip(keys, datasets, conversions):
+                chunk[key] = self._apply_conversion(read(dataset), conv)
+            yield chunk
+
+    def select_rows(self, keep):
+        """
+        Restrict the particle selection (and any loaded data) to a subset.
+        keep: boolean array over the currently selected particles.
+        Subsequent loads only read the selected rows from the HDF5 file.
+        """
+        keep = numpy.asarray(keep, dtype=bool)
+        if self._rows is None:
+            rows = numpy.flatnonzero(keep)
+        else:
+            rows = self._rows[keep]
+        self._rows_key = None
+        self._coords_version += 1
+        self._prefetched.clear()
+        for key in self._raw:
+            self._raw[key] = self._raw[key][keep]
+        if self.index.size:
+            # By position: after build_index the labels are particle IDs,
+            # which need not be unique.
+            self._update_inplace(self.take(numpy.flatnonzero(keep)))
+            if not self._indexed:
+                self.reset_index(drop=True, inplace=True)
+        self._rows = rows
+
+    def load_PIDs(self):
+        """
+        Load Particle ID numbers, indexing the DataFrame by them if it is
+        not yet.
+        """
+        if not self._indexed:
+            self.build_index()
+            return
+        self._store(self._read('particleIDs'), 'particleIDs')
 
     def get_PIDs(self):
         """
@@ -105,8 +622,7 @@ class PartType(DataFrame):
                 load_func = self._load_dict[key]
                 load_func()
             except(KeyError):
-                hdf5key = '_'+key.replace(' ', '_')
-                self[key] = vars(self)[hdf5key].value
+                self._store(self._converted(key.replace(' ', '_')), key)
 
     def load_all(self):
         """
@@ -125,6 +641,9 @@ class PartType(DataFrame):
             exclude += ('u', 'v', 'w')
         to_drop = [key for key in self.columns if key not in exclude]
         self.drop(to_drop, axis=1, inplace=True)
+        for key in self._raw.keys():
+            if key not in exclude:
+                del self._raw[key]
 
     def load_data(self, *properties, **kwargs):
         """
@@ -135,9 +654,15 @@ class PartType(DataFrame):
         properties: arbitrary number of keys from the list.
         refine (default True): refine to highest resolution particles only.
         stride: If set, take every stride'th particle.
+        processes: If set, read the requested datasets with up to this many
+                   reader processes at once (see prefetch).
         """
         #load primary quantities first.
         print 'Loading data...'
+        processes = kwargs.pop('processes', None)
+        if processes > 1:
+            self.prefetch([p for p in properties if p not in self._calculated],
+                          processes)
         for p in properties:
             if p not in self._calculated:
                 self.load_quantity(p)
@@ -151,6 +676,8 @@ class PartType(DataFrame):
             for prop in properties:
                 vars(self)[prop] = vars(self)[prop][::stride]
 
+        self._prefetched.clear()
+
         # Cleanup to save memory
         if kwargs.pop('cleanup', False):
             self.cleanup(*properties)
@@ -0,0 +1,94 @@
+# ledger.py
+"""
+This module contains a record of per-snapshot results of batch tasks, so
+that interrupted or repeated runs only process new or changed snapshots.
+"""
+import os
+import re
+import glob
+import shutil
+import tempfile
+import cPickle as pickle
+
+def stamp(filename):
+    """
+    Return the size and modification time of a snapshot file, or of all
+    pieces of a multi-file snapshot.
+    """
+    match = re.match(r'(.*)\.0\.hdf5$', filename)
+    if match is None:
+        files = [filename]
+    else:
+        files = sorted(glob.glob(match.group(1) + '.*.hdf5'))
+    result = []
+    for fname in files:
+        stat = os.stat(fname)
+        result.append((os.path.basename(fname), stat.st_size,
+                       int(stat.st_mtime)))
+    return tuple(result)
+
+class Ledger(object):
+    """
+    Results of a batch task, one file per snapshot in path/ledger/task-version.
+    Entries are written atomically as each snapshot is finished, and are
+    only valid while the snapshot file keeps the same size and mtime.
+    """
+    def __init__(self, path, task, version=0):
+        self.task = task
+        self.version = version
+        self.path = os.path.join(path, 'ledger', task + '-' + str(version))
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created meanwhile by another process.
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _file(self, num):
+        return os.path.join(self.path, '{:0>4}.pkl'.format(num))
+
+    def get(self, num, filename):
+        """
+        Return the result recorded for snapshot num.  Raises KeyError if
+        there is none, or if the snapshot file changed since.
+        """
+        try:
+            with open(self._file(num), 'rb') as f:
+                key, result = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            raise KeyError(num)
+        if key != stamp(filename):
+            raise KeyError(num)
+        return result
+
+    def done(self, num, filename):
+        """
+        Return whether a valid result is recorded for snapshot num.
+        """
+        try:
+            self.get(num, filename)
+        except KeyError:
+            return False
+        return True
+
+    def put(self, num, filename, result=None):
+        """
+        Record the result for snapshot num.
+        """
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((stamp(filename), result), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self._file(num))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def clear(self):
+        """
+        Remove every entry from the ledger.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
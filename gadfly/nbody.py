@@ -4,11 +4,19 @@
 This module contains classes for reading Gadget2 N-body (dark matter)
 particle data.
 """
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
 import numpy
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from pandas import Series, DataFrame
+from scipy.spatial import cKDTree
 
-from hdf5 import PartType
+from hdf5 import PartType, CHUNK_SIZE, read_rows
 import units
+import cache
 import coordinates
 import analyze
 import visualize
@@ -27,14 +35,9 @@ class PartTypeNbody(PartType):
             self.refine_dataset()
 
     def __getstate__(self):
-        result = self.__dict__.copy()
-        del result['_coordinates']
-        del result['_particleIDs']
-        del result['_velocities']
-        del result['_masses']
-        del result['_load_dict']
-        del result['loadable_keys']
-        del result['_calculated']
+        result = super(PartTypeNbody,self).__getstate__()
+        for key in ['_load_dict', 'loadable_keys', '_calculated']:
+            result.pop(key, None)
         return result
 
     def __setstate__(self, in_dict):
@@ -61,22 +64,41 @@ class PartTypeNbody(PartType):
 	        criterion = (self.masses > self.masses.min())
         super(PartTypeNbody, self).refine_dataset(criterion)
 
+    def _conversion(self, key, unit=None):
+        """
+        Return the factor converting dataset key from code units to unit
+        (default set in units class).
+        """
+        h = self._header.HubbleParam
+        a = self._header.ScaleFactor
+        physical = (self.units.coordinate_system == 'physical')
+        if key == 'masses':
+            conv = self.units.masses[unit or self.units.mass_unit]
+            if self.units.remove_h:
+                conv /= h
+        elif key == 'coordinates':
+            conv = self.units.lengths[unit or self.units.length_unit]
+            if self.units.remove_h:
+                conv /= h
+            if physical:
+                conv *= a
+        elif key == 'velocities':
+            conv = self.units.velocities[unit or self.units.velocity_unit]
+            if physical:
+                conv *= numpy.sqrt(a)
+        else:
+            conv = super(PartTypeNbody, self)._conversion(key, unit)
+        return conv
+
     def load_masses(self, unit=None):
         """
         Load Particle Masses in units of M_sun (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_mass(unit)
-        masses = self._masses.value * self.units.mass_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            masses /= h
-        if self._drop_ids is not None:
-            masses = Series(masses, index=self._particleIDs.value)
-            self['masses'] = masses.drop(self._drop_ids)
-        else:
-            self['masses'] = masses
+        unit = unit or self.units.mass_unit
+        masses = self._converted('masses', unit)
+        self._store(masses, 'masses')
+        self._loaded_units['masses'] = unit
 
     def get_masses(self, unit=None):
         """
@@ -84,7 +106,7 @@ class PartTypeNbody(PartType):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.mass_unit:
+            if unit != self._loaded_units.get('masses'):
                 self.load_masses(unit)
         try:
             return self.masses
@@ -97,35 +119,231 @@ class PartTypeNbody(PartType):
         Load Particle Coordinates in units of kpc (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units._set_coord_length(unit)
-        xyz = self._coordinates.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            xyz /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            xyz *= a
-        xyz = DataFrame(xyz, index=self._particleIDs.value, columns=['x', 'y', 'z'])
-        if self._drop_ids is not None:
-            xyz.drop(self._drop_ids, inplace=True)
-        self[['x', 'y', 'z']] = xyz
+        unit = unit or self.units.length_unit
+        xyz = self._converted('coordinates', unit)
+        self._store(xyz, 'x', 'y', 'z')
+        self._loaded_units['coordinates'] = unit
+        self._reoriented.discard('coordinates')
+        self._coords_version += 1
 
     def load_velocities(self, unit=None):
         """
         Load Particle Velocities in units of km/s (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_velocity(unit)
-        uvw = self._velocities.value * self.units.velocity_conv
+        unit = unit or self.units.velocity_unit
+        uvw = self._converted('velocities', unit)
+        self._store(uvw, 'u', 'v', 'w')
+        self._loaded_units['velocities'] = unit
+        self._reoriented.discard('velocities')
+
+    def load_region(self, center, radius, *keys, **kwargs):
+        """
+        Restrict the dataset to particles inside a sphere (or cube) without
+        reading the whole snapshot.  Coordinates are tested in chunks, and
+        later loads only read the rows of particles inside the region.
+        center: (x,y,z) of the region, in coordinate units.
+        radius: radius of the sphere, or half-width of the cube.
+        keys: optional keys to load for the selected particles.
+        shape: 'sphere' (default) or 'box'.
+        unit: length unit of center and radius (default: coordinate unit).
+        periodic: if True, wrap distances using the header BoxSize.
+        chunk_size: number of particles to test at a time.
+        """
+        shape = kwargs.pop('shape', 'sphere')
+        unit = kwargs.pop('unit', self._loaded_units.get('coordinates',
+                                                         self.units.length_unit))
+        periodic = kwargs.pop('periodic', False)
+        chunk_size = kwargs.pop('chunk_size', CHUNK_SIZE)
+        if shape not in ['sphere', 'box']:
+            raise KeyError("Region shape options: 'sphere' 'box'")
+        # Test coordinates in code units rather than converting every chunk.
+        conv = self.units.lengths[unit]
+        if self.units.remove_h:
+            conv /= self._header.HubbleParam
         if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            uvw *= numpy.sqrt(a)
-        uvw = DataFrame(uvw, index=self._particleIDs.value, columns=['u', 'v', 'w'])
-        if self._drop_ids is not None:
-            uvw.drop(self._drop_ids, inplace=True)
-        self[['u', 'v', 'w']] = uvw
+            conv *= self._header.ScaleFactor
+        center = numpy.asarray(center, dtype=numpy.float64) / conv
+        radius = radius / conv
+        boxsize = self._header.BoxSize
+
+        if self._rows is None:
+            nrows = self._coordinates.shape[0]
+        else:
+            nrows = self._rows.size
+        keep = numpy.empty(nrows, dtype=bool)
+        for start in xrange(0, nrows, chunk_size):
+            stop = min(start + chunk_size, nrows)
+            if self._rows is None:
+                xyz = self._coordinates[start:stop]
+            else:
+                xyz = read_rows(self._coordinates, self._rows[start:stop])
+            dx = xyz - center
+            if periodic:
+                dx = (dx + boxsize/2) % boxsize - boxsize/2
+            if shape == 'sphere':
+                keep[start:stop] = (dx * dx).sum(axis=1) <= radius * radius
+            else:
+                keep[start:stop] = (numpy.abs(dx) <= radius).all(axis=1)
+        self.select_rows(keep)
+        print keep.sum(), 'particles selected.'
+        if keys:
+            self.load_data(*keys, **kwargs)
+
+    def spatial_index(self, periodic=False):
+        """
+        Return a KD-tree (scipy.spatial.cKDTree) over the loaded x,y,z
+        coordinates, building it the first time.  The tree is kept until
+        the coordinates are reloaded, centered or rotated by orient_box, or
+        the selection changes.  Trees are saved in the spatial index
+        directory, keyed by the coordinates themselves (up to the
+        simulation's spatial_index_size, least recently used first out),
+        so later sessions load them instead.
+        periodic: if True, wrap coordinates in a periodic box of the header
+                  BoxSize.  Only meaningful for unrotated coordinates.
+        """
+        if 'x' not in self.columns:
+            self.load_coords()
+        version = (self._coords_version, periodic)
+        if (self._spatial_index is not None
+            and self._spatial_index[0] == version):
+            return self._spatial_index[1]
+
+        xyz = numpy.ascontiguousarray(self[['x', 'y', 'z']].values,
+                                      dtype=numpy.float64)
+        boxsize = None
+        if periodic:
+            boxsize = self._header.BoxSize * self._conversion('coordinates',
+                                         self._loaded_units.get('coordinates'))
+            xyz = numpy.mod(xyz, boxsize)
+        tree = None
+        fname = None
+        if self._spatial_index_path is not None:
+            key = hashlib.sha1(xyz).hexdigest() + '-' + repr(boxsize)
+            fname = os.path.join(self._spatial_index_path,
+                                 hashlib.sha1(key).hexdigest() + '.pkl')
+            try:
+                with open(fname, 'rb') as f:
+                    tree = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                tree = None
+            else:
+                # Mark as recently used.
+                try:
+                    os.utime(fname, None)
+                except OSError:
+                    pass
+        if tree is None:
+            tree = cKDTree(xyz, boxsize=boxsize)
+            if fname is not None:
+                self._save_spatial_index(tree, fname)
+        self._spatial_index = (version, tree)
+        return tree
+
+    def _save_spatial_index(self, tree, fname):
+        tmp = None
+        try:
+            if not os.path.isdir(self._spatial_index_path):
+                os.makedirs(self._spatial_index_path)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                                       dir=self._spatial_index_path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, fname)
+        except (IOError, OSError):
+            print 'Warning: could not save spatial index', fname
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        cache.evict(self._spatial_index_path, self._spatial_index_size,
+                    '.pkl')
+
+    def _query_points(self, points, periodic):
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+        if periodic:
+            tree = self.spatial_index(periodic)
+            points = numpy.mod(points, tree.boxsize)
+        return points
+
+    def query_ball(self, centers, radius, periodic=False, threads=None):
+        """
+        Return the row positions of particles within radius of a point,
+        or a list of them for an (N,3) array of points.
+        centers: point(s) in coordinate units.
+        threads: number of threads sharing the queries (default: one per
+                 core).
+        """
+        tree = self.spatial_index(periodic)
+        single = numpy.ndim(centers) == 1
+        points = self._query_points(centers, periodic)
+        results = _query_chunks(lambda chunk:
+                                list(tree.query_ball_point(chunk, radius)),
+                                points, threads)
+        results = [numpy.sort(numpy.asarray(rows, dtype=numpy.int64))
+                   for chunk in results for rows in chunk]
+        return results[0] if single else results
+
+    def query_knn(self, points, k, periodic=False, threads=None):
+        """
+        Return the distances and row positions of the k nearest particles
+        to each of an (N,3) array of points, as (N,k) arrays.
+        threads: number of threads sharing the queries (default: one per
+                 core).
+        """
+        tree = self.spatial_index(periodic)
+        points = self._query_points(points, periodic)
+        results = _query_chunks(lambda chunk: tree.query(chunk, k),
+                                points, threads)
+        distances = numpy.concatenate([d for d, i in results])
+        rows = numpy.concatenate([i for d, i in results])
+        return distances.reshape(len(points), -1), rows.reshape(len(points), -1)
+
+    def query_box(self, lower, upper, periodic=False):
+        """
+        Return the row positions of particles inside an axis-aligned box.
+        lower, upper: (x,y,z) corners of the box in coordinate units.
+        """
+        tree = self.spatial_index(periodic)
+        lower = numpy.asarray(lower, dtype=numpy.float64)
+        upper = numpy.asarray(upper, dtype=numpy.float64)
+        center = (lower + upper) / 2
+        half = (upper - lower) / 2
+        center = self._query_points(center, periodic)[0]
+        rows = numpy.asarray(tree.query_ball_point(center, half.max(),
+                                                   p=numpy.inf),
+                             dtype=numpy.int64)
+        dx = tree.data[rows] - center
+        if periodic:
+            dx = (dx + tree.boxsize/2) % tree.boxsize - tree.boxsize/2
+        return numpy.sort(rows[(numpy.abs(dx) <= half).all(axis=1)])
+
+    def find_groups(self, b=0.2, periodic=True, gas=None, **kwargs):
+        """
+        Find friends-of-friends groups of the loaded particles.  See
+        analyze.friends_of_friends.
+        b: linking length as a fraction of the mean interparticle spacing
+           of these particles.
+        periodic: if True, the box is periodic with the header BoxSize.
+                  Only meaningful for unrotated coordinates.
+        gas: optionally, the gas particles of the same snapshot, linked
+             together with these.  Member row positions past the number of
+             these particles refer to gas rows.
+        Other kwargs are passed to analyze.friends_of_friends.
+        Returns the group catalog and the member row positions.
+        """
+        xyz = self.get_coords().values
+        mass = self.get_masses().values
+        boxsize = None
+        if periodic:
+            boxsize = self._header.BoxSize * self._conversion('coordinates',
+                                         self._loaded_units.get('coordinates'))
+            kwargs.setdefault('spacing', boxsize / xyz.shape[0]**(1./3))
+        if gas is not None:
+            xyz = numpy.concatenate((xyz, gas.get_coords(
+                self._loaded_units.get('coordinates')).values))
+            mass = numpy.concatenate((mass, gas.get_masses(
+                self._loaded_units.get('masses')).values))
+        return analyze.friends_of_friends(xyz, b, mass, boxsize, **kwargs)
 
     def orient_box(self, **kwargs):
         """
@@ -143,8 +361,10 @@ class PartTypeNbody(PartType):
         try:
             pos_vel = self[xyz + uvw]
         except KeyError:
-            self.load_coords()
-            self.load_velocities()
+            if 'x' not in self.columns:
+                self.load_coords()
+            if 'u' not in self.columns:
+                self.load_velocities()
             pos_vel = self[xyz + uvw]
 
         if center:
@@ -158,6 +378,9 @@ class PartTypeNbody(PartType):
                 except AttributeError:
                     raise KeyError("Cannot density-center dark matter!")
                 pos_vel = analyze.center_box(pos_vel, density=dens, **kwargs)
+            elif centering in ['shrink', 'potential']:
+                mass = self.get_masses().values
+                pos_vel = analyze.center_box(pos_vel, mass=mass, **kwargs)
             elif centering == 'box':
                 pos_vel = analyze.center_box(pos_vel, **kwargs)
         self[pos_vel.keys()] = pos_vel
@@ -176,6 +399,9 @@ class PartTypeNbody(PartType):
             print 'Rotation complete.'
             self[['x', 'y', 'z']] = xyz
             self[['u', 'v', 'w']] = uvw
+        if center or centering or view:
+            self._reoriented.update(['coordinates', 'velocities'])
+        self._coords_version += 1
 
     def calculate_spherical_coords(self, c_unit=None, v_unit=None, **kwargs):
         """
@@ -184,8 +410,8 @@ class PartTypeNbody(PartType):
         unit: unit conversion from code units
         """
         if (c_unit or v_unit):
-            if (c_unit != self.units._coord_unit
-                or v_unit != self.units.velocity_unit):
+            if (c_unit != self._loaded_units.get('coordinates')
+                or v_unit != self._loaded_units.get('velocities')):
                 self.load_coords(c_unit)
                 self.load_velocities(v_unit)
         self.orient_box(**kwargs)
@@ -205,8 +431,8 @@ class PartTypeNbody(PartType):
         unit: unit conversion from code units
         """
         if (c_unit or v_unit):
-            if (c_unit != self.units._coord_unit
-                or v_unit != self.units.velocity_unit):
+            if (c_unit != self._loaded_units.get('coordinates')
+                or v_unit != self._loaded_units.get('velocities')):
                 self.load_coords(c_unit)
                 self.load_velocities(v_unit)
         self.orient_box(**kwargs)
@@ -223,7 +449,8 @@ class PartTypeNbody(PartType):
         """
         system = kwargs.pop('system','cartesian')
         if (unit or len(kwargs) > 0):
-            if (unit != self.units._coord_unit or len(kwargs) > 0):
+            if (unit != self._loaded_units.get('coordinates')
+                or len(kwargs) > 0):
                 if system == 'cartesian':
                     self.load_coords(unit)
                     self.orient_box(**kwargs)
@@ -266,7 +493,8 @@ class PartTypeNbody(PartType):
         """
         system = kwargs.pop('system','cartesian')
         if (unit or len(kwargs) > 0):
-            if (unit != self.units.velocity_unit or len(kwargs) > 0):
+            if (unit != self._loaded_units.get('velocities')
+                or len(kwargs) > 0):
                 if system == 'cartesian':
                     self.load_velocities(unit)
                     self.orient_box(**kwargs)
@@ -297,3 +525,18 @@ class PartTypeNbody(PartType):
         else:
             raise KeyError("Coordinate system options: 'cartesian' "\
                            "'spherical' 'cylindrical'")
+
+def _query_chunks(query, points, threads=None):
+    """
+    Split points among threads and return the list of query results.
+    cKDTree queries release the GIL, so the threads run concurrently.
+    """
+    nchunks = max(min(threads or mp.cpu_count(), len(points)), 1)
+    chunks = numpy.array_split(points, nchunks)
+    if nchunks == 1:
+        return [query(points)]
+    pool = ThreadPool(nchunks)
+    try:
+        return pool.map(query, chunks)
+    finally:
+        pool.close()
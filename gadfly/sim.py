@@ -1,15 +1,23 @@
 # sim.py
 # Jacob Hummel
 import os
+import time
 import glob
+import shutil
 import numpy
+import pandas
 import subprocess
+import h5py
 import threading
 import Queue
 import multiprocessing as mp
 
 import units
+import cache
+import hdf5
 import snapshot
+import transport
+import ledger
 
 class Simulation(object):
     """
@@ -29,6 +37,56 @@ class Simulation(object):
                                      
         self.refine_gas = simargs.pop('refine_gas', False)
         self.refine_nbody = simargs.pop('refine_nbody', False)
+        # Defer reading particle data (including ID numbers) until needed.
+        self.lazy_load = simargs.pop('lazy_load', False)
+
+        # Keep a code-unit copy of fields once read, so loading them again
+        # in other units never re-reads them.  Off by default, as it
+        # doubles the memory held by loaded fields.
+        self.cache_raw = simargs.pop('cache_raw', False)
+        # Floating point precision of loaded fields: 'native' keeps the
+        # precision of the snapshot data, 'float32' or 'float64' force it.
+        self.dtype = simargs.pop('dtype', 'native')
+        if self.dtype not in ['native', 'float32', 'float64']:
+            raise KeyError("dtype options: 'native' 'float32' 'float64'")
+        # Opt-in on-disk cache of converted fields.  field_cache is a
+        # directory, or True for a directory in savepath.
+        field_cache = simargs.pop('field_cache', None)
+        field_cache_size = simargs.pop('field_cache_size', 10*2**30)
+        if field_cache is True:
+            field_cache = os.path.join(self.savepath, 'field_cache')
+        if field_cache:
+            self.field_cache = cache.FieldCache(field_cache, field_cache_size)
+        else:
+            self.field_cache = None
+
+        # HDF5 file access options for snapshots: raw data chunk cache
+        # size (bytes), number of hash table slots and preemption policy
+        # (0-1), and file driver (e.g. 'sec2', or 'core' for small files).
+        self.hdf5_options = {}
+        for kwarg, option in [('chunk_cache_size', 'rdcc_nbytes'),
+                              ('chunk_cache_slots', 'rdcc_nslots'),
+                              ('chunk_cache_preemption', 'rdcc_w0'),
+                              ('driver', 'driver')]:
+            value = simargs.pop(kwarg, None)
+            if value is not None:
+                self.hdf5_options[option] = value
+
+        # Sorted particle ID indices are kept in savepath/id_index, unless
+        # id_index is False.
+        if simargs.pop('id_index', True):
+            self.id_index_path = os.path.join(self.savepath, 'id_index')
+        else:
+            self.id_index_path = None
+        # KD-trees over particle positions are kept in
+        # savepath/spatial_index, unless spatial_index is False.  The least
+        # recently used are removed beyond spatial_index_size bytes.
+        self.spatial_index_size = simargs.pop('spatial_index_size', 4*2**30)
+        if simargs.pop('spatial_index', True):
+            self.spatial_index_path = os.path.join(self.savepath,
+                                                   'spatial_index')
+        else:
+            self.spatial_index_path = None
 
         self.coordinates = simargs.pop('coordinates', 'physical')
         self.batch_viewscale = None
@@ -37,6 +95,7 @@ class Simulation(object):
         self.units.set_coordinate_system(self.coordinates)
 
         self.snapfiles = self.find_snapshots(self.snapfile_base)
+        self._catalog = None
 
     def set_field_names(self, name_dict={}):
         self.hdf5_fields = {'particleIDs':'ParticleIDs',
@@ -65,14 +124,20 @@ class Simulation(object):
             raise KeyError
 
     def find_snapshots(self, snapfile_base, *nums):
-        files0 = glob.glob(self.filepath+'/'+snapfile_base+'_???.hdf5')
-        files1 = glob.glob(self.filepath+'/'+snapfile_base+'_????.hdf5')
-        files0.sort()
-        files1.sort()
-        files = files0 + files1
+        files = []
+        # Single-file snapshots, then the first piece of multi-file
+        # snapshots, either alongside them or in snapdir_NNN directories.
+        for digits in ['???', '????']:
+            for pattern in [snapfile_base+'_'+digits+'.hdf5',
+                            snapfile_base+'_'+digits+'.0.hdf5',
+                            'snapdir_'+digits+'/'+snapfile_base+'_'
+                            +digits+'.0.hdf5']:
+                found = glob.glob(self.filepath+'/'+pattern)
+                found.sort()
+                files += found
         snapfiles = {}
         for f in files:
-            num = int(f[:-5].split('_')[-1])
+            num = int(os.path.basename(f).split('.')[0].split('_')[-1])
             if nums:
                 if num in nums:
                     snapfiles[num] = f
@@ -83,20 +148,125 @@ class Simulation(object):
     def set_snapshots(self, *nums):
         self.snapfiles = self.find_snapshots(*nums)
 
-    def load_snapshot(self, num, *load_keys,**kwargs):
-        if ((kwargs.pop('refine_gas',False)) or self.refine_gas):
-            kwargs['refine_gas'] = True
-        if ((kwargs.pop('refine_nbody',False)) or self.refine_nbody):
-            kwargs['refine_nbody'] = True
+    def _catalog_file(self):
+        return os.path.join(self.savepath, self.name + '_catalog.pkl')
 
-        try:
+    def get_catalog(self, update=True):
+        """
+        Return a DataFrame of header attributes for every snapshot, indexed
+        by snapshot number.  Headers are cached in a catalog file in
+        savepath and only re-read from snapshots whose file size or
+        modification time has changed since they were cataloged.
+        update: if False, return the cached catalog without checking files.
+        """
+        catalog = self._catalog
+        if catalog is None:
+            try:
+                catalog = pandas.read_pickle(self._catalog_file())
+            except Exception:
+                catalog = pandas.DataFrame(columns=['filename', 'size',
+                                                    'mtime'])
+        if not update:
+            self._catalog = catalog
+            return catalog
+
+        current = []
+        headers = []
+        nums = []
+        for num in sorted(self.snapfiles):
             fname = self.snapfiles[num]
+            stat = os.stat(fname)
+            if (num in catalog.index
+                and catalog.at[num, 'filename'] == fname
+                and catalog.at[num, 'size'] == stat.st_size
+                and catalog.at[num, 'mtime'] == stat.st_mtime):
+                current.append(num)
+            else:
+                file_id = h5py.File(fname, 'r')
+                header = vars(hdf5.Header(file_id)).copy()
+                file_id.close()
+                header.update(filename=fname, size=stat.st_size,
+                              mtime=stat.st_mtime)
+                headers.append(header)
+                nums.append(num)
+        stale = len(current) < catalog.index.size
+        catalog = catalog.loc[current]
+        if headers:
+            catalog = pandas.concat([catalog,
+                                     pandas.DataFrame(headers, index=nums)])
+            catalog.sort_index(inplace=True)
+        if headers or stale:
+            fname = self._catalog_file()
+            try:
+                catalog.to_pickle(fname + '.tmp')
+                os.rename(fname + '.tmp', fname)
+            except (IOError, OSError):
+                print 'Warning: could not write snapshot catalog', fname
+        self._catalog = catalog
+        return catalog
+
+    def _catalog_column(self, key):
+        aliases = {'redshift':'Redshift',
+                   'time':'Time',
+                   'scale_factor':'ScaleFactor'}
+        catalog = self.get_catalog()
+        try:
+            return catalog[aliases.get(key, key)]
+        except KeyError:
+            raise KeyError(key + ' is not a header attribute.')
+
+    def select(self, **ranges):
+        """
+        Return sorted snapshot numbers whose header values fall within
+        (inclusive) ranges, using the snapshot catalog.
+        e.g. sim.select(redshift=(15, 20))
+        """
+        keep = None
+        for key, (lo, hi) in ranges.items():
+            values = self._catalog_column(key)
+            inrange = (values >= min(lo, hi)) & (values <= max(lo, hi))
+            keep = inrange if keep is None else keep & inrange
+        if keep is None:
+            return sorted(self.snapfiles)
+        return list(keep.index[keep.values])
+
+    def nearest(self, **value):
+        """
+        Return the number of the snapshot whose header value is nearest to
+        the one given, using the snapshot catalog.
+        e.g. sim.nearest(time=0.05)
+        """
+        if len(value) != 1:
+            raise KeyError("nearest() takes exactly one header key.")
+        key, target = value.items()[0]
+        values = self._catalog_column(key)
+        return values.index[numpy.abs(values.values - target).argmin()]
+
+    def _snapfile(self, num):
+        try:
+            return self.snapfiles[num]
         except KeyError:
             try:
-                fname = self.find_snapshots(num)[num]
+                return self.find_snapshots(self.snapfile_base, num)[num]
             except KeyError:
                 raise IOError('Sim ' + self.name + ' snapshot '
                               + str(num) + ' not found!')
+
+    def _ledger(self, task, version=0):
+        """
+        Return the ledger of a batch task, given as a name or a Ledger.
+        """
+        if task is None or isinstance(task, ledger.Ledger):
+            return task
+        return ledger.Ledger(self.savepath, task, version)
+
+    def load_snapshot(self, num, *load_keys,**kwargs):
+        if ((kwargs.pop('refine_gas',False)) or self.refine_gas):
+            kwargs['refine_gas'] = True
+        if ((kwargs.pop('refine_nbody',False)) or self.refine_nbody):
+            kwargs['refine_nbody'] = True
+
+        fname = self._snapfile(num)
         snap = snapshot.File(self, fname, **kwargs)
 
         #if load_keys:
@@ -105,35 +275,436 @@ class Simulation(object):
         #    snap.gas.cleanup()
         return snap
 
+    def map(self, func, snapshots=None, fields=None, workers=None,
+            ledger=None, version=0, **kwargs):
+        """
+        Apply func(snapshot) to a series of snapshots in a process pool and
+        collect the results in a DataFrame indexed by snapshot number, with
+        the snapshot redshift and time as columns.
+        func: function returning a dict or Series (one row), a DataFrame
+              (several rows) or a scalar (column 'value').  It is run in
+              worker processes, so must be defined at module level.
+        snapshots: snapshot numbers (default: all).
+        fields: keys to load before calling func, either a list of gas
+                keys or a dict such as {'gas':['density'], 'dm':['masses']}.
+                Snapshots are opened with lazy_load, so nothing else is read.
+        workers: number of worker processes (default: one per extra core).
+                 With workers=1, snapshots are processed in this process.
+        ledger: task name (or ledger.Ledger) under which the result of
+                each snapshot is recorded in savepath as soon as it is
+                done.  Snapshots with a recorded result are skipped, unless
+                their file changed since.
+        version: task version; changing it discards recorded results.
+        Results are returned in snapshot order, and at most 2*workers
+        snapshots are in flight at a time.  Other kwargs are passed to
+        load_snapshot.
+        """
+        if snapshots is None:
+            snapshots = sorted(self.snapfiles)
+        if fields is None:
+            fields = {}
+        elif not isinstance(fields, dict):
+            fields = {'gas':list(fields)}
+        if workers is None:
+            workers = max(mp.cpu_count() - 1, 1)
+        kwargs.setdefault('lazy_load', True)
+        record = self._ledger(ledger, version)
+
+        frames = []
+        if workers == 1:
+            for num in snapshots:
+                if record is None:
+                    frames.append(_map_snapshot(self, num, func,
+                                                fields, kwargs))
+                    continue
+                fname = self._snapfile(num)
+                try:
+                    frames.append(record.get(num, fname))
+                except KeyError:
+                    frame = _map_snapshot(self, num, func, fields, kwargs)
+                    record.put(num, fname, frame)
+                    frames.append(frame)
+        else:
+            pool = mp.Pool(workers)
+            pending = []
+            try:
+                for num in snapshots:
+                    if len(pending) >= 2*workers:
+                        frames.append(pending.pop(0).get())
+                    callback = None
+                    if record is not None:
+                        fname = self._snapfile(num)
+                        try:
+                            frame = record.get(num, fname)
+                        except KeyError:
+                            callback = _Recorder(record, num, fname)
+                        else:
+                            pending.append(_Done(frame))
+                            continue
+                    pending.append(pool.apply_async(_map_snapshot,
+                                                    (self, num, func,
+                                                     fields, kwargs),
+                                                    callback=callback))
+                for result in pending:
+                    frames.append(result.get())
+            finally:
+                pool.terminate()
+                pool.join()
+        if not frames:
+            return pandas.DataFrame()
+        results = pandas.concat(frames)
+        results.index.name = 'snapshot'
+        return results
+
+    def track(self, ids, fields, snapshots=None, ptype='gas', output=None,
+              workers=None, dtype=numpy.float32, **kwargs):
+        """
+        Follow particles through a series of snapshots, reading only their
+        rows from each snapshot.
+        ids: particle ID numbers.
+        fields: dataset keys to track, e.g. ['coordinates', 'density'],
+                in default units.
+        snapshots: snapshot numbers (default: all).
+        ptype: particle type group, e.g. 'gas' or 'dm'.
+        output: if set, the HDF5 file the tracks are written to as each
+                snapshot is done, instead of being returned.  It holds a
+                'tracks' dataset of shape (snapshots, ids, columns),
+                with 'snapshots', 'ids', 'redshift' and 'time' datasets
+                and the column names as the 'columns' attribute.
+        workers: number of worker processes (default: one per extra core).
+        dtype: floating point type of the tracks.
+        Particles missing from a snapshot get NaN values.  Returns a
+        DataFrame indexed by snapshot and particle ID, or the output file
+        name.  Other kwargs are passed to load_snapshot.
+        """
+        ids = numpy.asarray(ids)
+        if snapshots is None:
+            snapshots = sorted(self.snapfiles)
+        if isinstance(fields, basestring):
+            fields = [fields]
+        if workers is None:
+            workers = max(mp.cpu_count() - 1, 1)
+        kwargs.setdefault('lazy_load', True)
+        args = [(self, num, ids, ptype, fields, dtype, kwargs)
+                for num in snapshots]
+        if workers == 1:
+            pool = None
+            results = (_track_snapshot(*a) for a in args)
+        else:
+            pool = mp.Pool(workers)
+            results = pool.imap(_track_snapshot_args, args)
+
+        tracks = None
+        try:
+            for i, (columns, redshift, time, block) in enumerate(results):
+                if tracks is None:
+                    shape = (len(snapshots), ids.size, len(columns))
+                    if output is None:
+                        tracks = numpy.empty(shape, dtype=dtype)
+                        redshifts = numpy.empty(len(snapshots))
+                        times = numpy.empty(len(snapshots))
+                    else:
+                        tracks = h5py.File(output, 'w')
+                        tracks.attrs['columns'] = columns
+                        tracks['snapshots'] = numpy.asarray(snapshots)
+                        tracks['ids'] = ids
+                        redshifts = tracks.create_dataset('redshift',
+                                                          (len(snapshots),))
+                        times = tracks.create_dataset('time',
+                                                      (len(snapshots),))
+                        tracks.create_dataset('tracks', shape, dtype=dtype,
+                                              chunks=(1,)+shape[1:])
+                if output is None:
+                    tracks[i] = block
+                else:
+                    tracks['tracks'][i] = block
+                    tracks.flush()
+                redshifts[i] = redshift
+                times[i] = time
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if output is not None and tracks is not None:
+                tracks.close()
+        if output is not None:
+            return output
+        if tracks is None:
+            return pandas.DataFrame()
+        index = pandas.MultiIndex.from_product([snapshots, ids],
+                                               names=['snapshot',
+                                                      'particleIDs'])
+        frame = pandas.DataFrame(tracks.reshape(-1, tracks.shape[2]),
+                                 index=index, columns=columns)
+        frame.insert(0, 'time', numpy.repeat(times, ids.size))
+        frame.insert(0, 'redshift', numpy.repeat(redshifts, ids.size))
+        return frame
+
+    def iter_snapshots(self, fields=None, snapshots=None, prefetch=2,
+                       max_bytes=2**30, **kwargs):
+        """
+        Iterate over snapshots, reading the following ones in a separate
+        process while the current one is processed.  Their particle data
+        is handed over through shared memory (see transport).
+        fields: keys to load, as a list of gas keys or a dict such as
+                {'gas':['density'], 'dm':['masses']}.  Snapshots are
+                opened with lazy_load, so nothing else is read.
+        snapshots: snapshot numbers (default: all).
+        prefetch: maximum number of snapshots read ahead.
+        max_bytes: memory budget for the snapshot being processed and those
+                   read ahead, estimated from the size of the last snapshot
+                   loaded.  At least one snapshot is always read ahead.
+        Snapshot files are closed once read, so only the fields loaded are
+        available.  Other kwargs are passed to load_snapshot.
+        """
+        if snapshots is None:
+            snapshots = sorted(self.snapfiles)
+        else:
+            snapshots = list(snapshots)
+        if fields is None:
+            fields = {}
+        elif not isinstance(fields, dict):
+            fields = {'gas':list(fields)}
+        kwargs.setdefault('lazy_load', True)
+
+        # The loader reads one snapshot per request, so the number and
+        # estimated size of the snapshots read ahead stay within budget.
+        requests = mp.Queue()
+        ready = mp.Queue()
+        shared_dir = transport.shared_directory()
+        loader = mp.Process(target=_prefetch_snapshots,
+                            args=(self, snapshots, fields, kwargs,
+                                  requests, ready, shared_dir))
+        loader.daemon = True
+        state = {'requested':0, 'ahead':0, 'held':0, 'estimate':0}
+
+        def request():
+            while state['requested'] < len(snapshots) and \
+                  state['ahead'] < prefetch and \
+                  (state['ahead'] == 0 or state['held'] + (state['ahead']+1)
+                   * state['estimate'] <= max_bytes):
+                requests.put(True)
+                state['requested'] += 1
+                state['ahead'] += 1
+
+        def receive():
+            while True:
+                try:
+                    return ready.get(timeout=1)
+                except Queue.Empty:
+                    if not loader.is_alive():
+                        try:
+                            return ready.get_nowait()
+                        except Queue.Empty:
+                            raise RuntimeError('snapshot loader exited')
+
+        loader.start()
+        try:
+            while True:
+                request()
+                item = receive()
+                if item is None:
+                    break
+                num, payload, nbytes = item
+                if payload is None:
+                    raise nbytes
+                state['ahead'] -= 1
+                state['held'] = nbytes
+                state['estimate'] = nbytes
+                snap = transport.load(payload)
+                request()
+                yield snap
+                del snap
+                state['held'] = 0
+        finally:
+            requests.put(None)
+            requests.cancel_join_thread()
+            loader.join(1)
+            if loader.is_alive():
+                loader.terminate()
+                loader.join()
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
     def multitask(self, task, *data, **kwargs):
+        """
+        Run task(snapshot, path) on every snapshot, loading snapshots in a
+        separate thread and computing in parallel processes.
+        parallel (default True): use one compute process per extra core.
+        transport: 'pickle' (default) sends snapshots to compute processes
+                   through the queue; 'shared' places their particle data
+                   in shared memory and sends only small descriptors.
+        ledger: task name (or ledger.Ledger) under which finished snapshots
+                are recorded in savepath.  Recorded snapshots are skipped,
+                unless their file changed since.
+        version: task version; changing it discards recorded snapshots.
+        """
         maxprocs = mp.cpu_count() - 1
         file_queue = mp.Queue()
         data_queue = mp.Queue(maxprocs/4)
-        loader = snapshot.Loader(self.load_snapshot, file_queue, data_queue)
+        if kwargs.pop('transport', 'pickle') == 'shared':
+            shared_dir = transport.shared_directory()
+        else:
+            shared_dir = None
+        record = self._ledger(kwargs.pop('ledger', None),
+                              kwargs.pop('version', 0))
+        loader = Loader(self.load_snapshot, file_queue, data_queue, shared_dir)
         loader.start()
-        snaps = self.snapfiles.keys()
-        snaps.sort()
-        for snap in snaps:
-            args = (snap,)+data
-            file_queue.put(args)
-        for i in range(maxprocs):
-            file_queue.put(None)
+        try:
+            snaps = self.snapfiles.keys()
+            snaps.sort()
+            for snap in snaps:
+                if record is not None and record.done(snap, self.snapfiles[snap]):
+                    continue
+                args = (snap,)+data
+                file_queue.put(args)
+            for i in range(maxprocs):
+                file_queue.put(None)
+
+            jobs = []
+            if kwargs.pop('parallel', True):
+                for i in range(maxprocs):
+                    p = mp.Process(target=self.controller,
+                                   args=(task,data_queue,record))
+                    p.start()
+                    jobs.append(p)
+                for process in jobs:
+                    process.join()
+
+            else:
+                file_queue.put(None)
+                self.controller(task, data_queue, record)
+        finally:
+            # Don't block on exit flushing snapshots nobody will read.
+            data_queue.cancel_join_thread()
+            loader.join()
+            if shared_dir is not None:
+                shutil.rmtree(shared_dir, ignore_errors=True)
 
+    def _next_snapfile(self, num):
+        """
+        Return the file name of snapshot num if it exists, else None.
+        Only the names find_snapshots would match are checked.
+        """
+        for digits in ['{:0>3}', '{:0>4}']:
+            n = digits.format(num)
+            if len(n) != len(digits.format(0)):
+                continue
+            for name in [self.snapfile_base+'_'+n+'.hdf5',
+                         self.snapfile_base+'_'+n+'.0.hdf5',
+                         'snapdir_'+n+'/'+self.snapfile_base+'_'+n+'.0.hdf5']:
+                fname = self.filepath+'/'+name
+                if os.path.exists(fname):
+                    return fname
+        return None
+
+    def _written(self, fname):
+        """
+        Return the size and mtime of a snapshot if it can be opened and its
+        header read, else None.
+        """
+        try:
+            file_id = snapshot.open_hdf5(fname)
+            try:
+                hdf5.Header(file_id)
+            finally:
+                file_id.close()
+            return ledger.stamp(fname)
+        except (IOError, OSError, KeyError):
+            return None
+
+    def follow(self, task, *data, **kwargs):
+        """
+        Run task(snapshot, path) on every snapshot, as in multitask, then
+        wait for new snapshots and run it on them as they are written.
+        Snapshots older than the newest one on disk are queued at once.
+        The newest and any new snapshot is processed once its header can be
+        read and its size stays the same between two checks.  Only the next
+        snapshot number is checked, polling at intervals growing from poll
+        to max_poll seconds while nothing changes.
+        start: first snapshot number (default 0).
+        poll (default 10), max_poll (default 300): polling intervals (s).
+        timeout: stop after this many seconds without a new snapshot
+                 (default: follow until interrupted).
+        parallel (default False): use one compute process per extra core,
+                                  instead of a single one.
+        transport, ledger, version: as in multitask.
+        """
+        start = kwargs.pop('start', 0)
+        poll = kwargs.pop('poll', 10)
+        max_poll = kwargs.pop('max_poll', 300)
+        timeout = kwargs.pop('timeout', None)
+        if kwargs.pop('parallel', False):
+            nprocs = max(mp.cpu_count() - 1, 1)
+        else:
+            nprocs = 1
+        file_queue = mp.Queue()
+        data_queue = mp.Queue(max(nprocs/4, 1))
+        if kwargs.pop('transport', 'pickle') == 'shared':
+            shared_dir = transport.shared_directory()
+        else:
+            shared_dir = None
+        record = self._ledger(kwargs.pop('ledger', None),
+                              kwargs.pop('version', 0))
+        # Block until the next snapshot is queued, rather than stopping
+        # once the queue runs dry.
+        loader = Loader(self.load_snapshot, file_queue, data_queue,
+                        shared_dir, timeout=None)
+        loader.start()
         jobs = []
-        if kwargs.pop('parallel', True):
-            for i in range(maxprocs):
-                p = mp.Process(target=self.controller,
-                               args=(task,data_queue))
-                p.start()
-                jobs.append(p)
+        for i in range(nprocs):
+            p = mp.Process(target=self.controller,
+                           args=(task,data_queue,record))
+            p.start()
+            jobs.append(p)
+
+        num = start
+        last = None
+        delay = poll
+        waiting = time.time()
+        try:
+            # Every snapshot but the newest was finished before a later one
+            # was started, so only the newest needs to be watched.
+            existing = self.find_snapshots(self.snapfile_base)
+            nums = sorted(n for n in existing if n >= start)
+            for n in nums[:-1]:
+                self.snapfiles[n] = existing[n]
+                if record is None or not record.done(n, existing[n]):
+                    file_queue.put((n,)+data)
+            if nums:
+                num = nums[-1]
+            while True:
+                fname = self._next_snapfile(num)
+                if fname is not None:
+                    size = self._written(fname)
+                    if size is not None and size == last:
+                        self.snapfiles[num] = fname
+                        if record is None or not record.done(num, fname):
+                            file_queue.put((num,)+data)
+                        num += 1
+                        last = None
+                        delay = poll
+                        waiting = time.time()
+                        continue
+                    if size != last:
+                        delay = poll
+                    last = size
+                if timeout is not None and time.time() - waiting > timeout:
+                    break
+                time.sleep(delay)
+                delay = min(2*delay, max_poll)
+        except KeyboardInterrupt:
+            print 'Stopped following', self.name
+        finally:
+            for i in range(nprocs):
+                file_queue.put(None)
+            file_queue.put(Loader.STOP)
             for process in jobs:
                 process.join()
+            loader.join()
+            if shared_dir is not None:
+                shutil.rmtree(shared_dir, ignore_errors=True)
 
-        else:
-            file_queue.put(None)
-            self.controller(task, data_queue)
-
-    def controller(self, task, data_queue):
+    def controller(self, task, data_queue, record=None):
         print "Starting compute process..."
         done = False
         while not done:
@@ -145,25 +716,164 @@ class Simulation(object):
                 done = True
                 break
             else:
+                if isinstance(snap, str):
+                    snap = transport.load(snap)
                 wp = self.plotpath + self.name
                 task(snap, wp)
+                if record is not None:
+                    record.put(snap.number, snap.filename)
         print "Compute process complete."
 
+def _load_fields(sim, num, fields, load_kwargs):
+    """
+    Load snapshot num with the requested fields, given as a dict of
+    particle type: list of keys.
+    """
+    snap = sim.load_snapshot(num, **load_kwargs)
+    for ptype, keys in fields.items():
+        if keys:
+            vars(snap)[ptype].load_data(*keys)
+    return snap
+
+def _prefetch_snapshots(sim, snapshots, fields, load_kwargs, requests, ready,
+                        shared_dir):
+    """
+    Loader process for Simulation.iter_snapshots: read the next snapshot
+    whenever one is requested, and pass it on through shared memory.
+    """
+    for num in snapshots:
+        if requests.get() is None:
+            return
+        try:
+            snap = _load_fields(sim, num, fields, load_kwargs)
+            nbytes = _snapshot_nbytes(snap)
+            snap.close()
+            payload = transport.dump(snap, shared_dir)
+        except Exception as error:
+            ready.put((num, None, error))
+            return
+        ready.put((num, payload, nbytes))
+    ready.put(None)
+
+def _snapshot_nbytes(snap):
+    """
+    Return the memory held by the particle data of a snapshot.
+    """
+    nbytes = 0
+    for ptype in vars(snap).values():
+        if isinstance(ptype, hdf5.PartType):
+            nbytes += ptype.memory_usage(index=True).sum()
+            nbytes += sum(values.nbytes for values in ptype._raw.values())
+    return nbytes
+
+class _Recorder(object):
+    """
+    Pool callback recording the result of a snapshot in a ledger.
+    """
+    def __init__(self, record, num, fname):
+        self.record = record
+        self.num = num
+        self.fname = fname
+
+    def __call__(self, frame):
+        self.record.put(self.num, self.fname, frame)
+
+class _Done(object):
+    """
+    Stand-in for the pending result of a snapshot already recorded.
+    """
+    def __init__(self, frame):
+        self.frame = frame
+
+    def get(self):
+        return self.frame
+
+def _track_snapshot(sim, num, ids, ptype, fields, dtype, load_kwargs):
+    """
+    Read fields for the particles ids of snapshot num, for Simulation.track.
+    Returns the column names, redshift, time and an (ids, columns) array.
+    """
+    snap = sim.load_snapshot(num, **load_kwargs)
+    part = vars(snap)[ptype]
+    positions = part.positions_of(ids)
+    found = positions >= 0
+    part.select_ids(ids[found])
+    # Refinement may have dropped some of them; those stay NaN.
+    found &= numpy.in1d(positions, part._rows)
+    # Rows are read in file order; map them back to the order of ids.
+    order = numpy.searchsorted(part._rows, positions[found])
+    names = {'coordinates':['x', 'y', 'z'], 'velocities':['u', 'v', 'w']}
+    columns = []
+    blocks = []
+    for key in fields:
+        values = part._converted(key.replace(' ', '_'))
+        if values.ndim > 1:
+            columns += names.get(key, [key + '_' + str(i)
+                                       for i in range(values.shape[1])])
+        else:
+            columns.append(key)
+            values = values[:,None]
+        blocks.append(values[order])
+    block = numpy.full((ids.size, len(columns)), numpy.nan, dtype=dtype)
+    block[found] = numpy.hstack(blocks)
+    redshift = snap.header.Redshift
+    time = snap.header.Time
+    snap.close()
+    return columns, redshift, time, block
+
+def _track_snapshot_args(args):
+    return _track_snapshot(*args)
+
+def _map_snapshot(sim, num, func, fields, load_kwargs):
+    """
+    Load the requested fields of snapshot num, apply func and return the
+    result as a DataFrame for Simulation.map.
+    """
+    snap = _load_fields(sim, num, fields, load_kwargs)
+    result = func(snap)
+    redshift = snap.header.Redshift
+    time = snap.header.Time
+    snap.close()
+    if isinstance(result, pandas.DataFrame):
+        frame = result.copy()
+    elif isinstance(result, (dict, pandas.Series)):
+        frame = pandas.DataFrame([result])
+    else:
+        frame = pandas.DataFrame({'value':[result]})
+    frame.index = [num] * len(frame.index)
+    frame.insert(0, 'time', time)
+    frame.insert(0, 'redshift', redshift)
+    return frame
+
 #===============================================================================
 class Loader(threading.Thread):
-    def __init__(self, load_function, file_queue, data_queue):
+    """
+    Thread loading snapshots for compute processes.  If shared_dir is set,
+    snapshots are handed over through transport.dump, with their
+    particle data in shared memory files in shared_dir.  The thread stops
+    once no snapshot is queued for timeout seconds (None: never), or when
+    it gets Loader.STOP.
+    """
+    STOP = 'stop'
+
+    def __init__(self, load_function, file_queue, data_queue, shared_dir=None,
+                 timeout=1):
         self.file_queue = file_queue
+        self.timeout = timeout
         self.data_queue = data_queue
         self.load_function = load_function
+        self.shared_dir = shared_dir
         threading.Thread.__init__(self)
 
     def run(self):
         lock = threading.Lock()
         while 1:
             try:
-                args = self.file_queue.get(timeout=1)
+                args = self.file_queue.get(timeout=self.timeout)
             except Queue.Empty:
                 break # reached end of queue
+            if args == self.STOP:
+                break
             if args is None:
                 self.data_queue.put(None)
             else:
@@ -174,9 +884,17 @@ class Loader(threading.Thread):
                 try:
                     snapshot = self.load_function(*args)
                     snapshot.close()
+                    if self.shared_dir is not None:
+                        snapshot = transport.dump(snapshot, self.shared_dir)
                     self.data_queue.put(snapshot)
                 except IOError:
                     lock.acquire()
                     print 'Warning: snapshot '+str(fname)+' not found!'
                     lock.release()
-                    pass
+                except Exception as err:
+                    # Keep going, so that the compute processes still get
+                    # their sentinels instead of waiting forever.
+                    lock.acquire()
+                    print 'Warning: failed to load snapshot '+str(fname)+':', \
+                        repr(err)
+                    lock.release()
@@ -4,16 +4,44 @@
 This module contains classes for reading Gadget2 HDF5 snapshot files.
 """
 import os
+import re
 import string
 import threading
 import Queue
 import h5py
 import numpy
+import pandas
 
-from hdf5 import Header
+from hdf5 import Header, MultiFile
 from nbody import PartTypeNbody
 from sph import PartTypeSPH
 
+def open_hdf5(filename, **options):
+    """
+    Open a snapshot file.  Snapshots written in several pieces
+    (NumFilesPerSnapshot > 1, named base.N.hdf5) are opened together and
+    presented as a single file.
+    options: passed to h5py.File, e.g. rdcc_nbytes, rdcc_nslots, rdcc_w0
+             (raw data chunk cache) or driver.
+    """
+    file_id = h5py.File(filename, 'r', **options)
+    nfiles = file_id['Header'].attrs.get('NumFilesPerSnapshot', 1)
+    if nfiles <= 1:
+        return file_id
+    match = re.match(r'(.*)\.(\d+)\.hdf5$', filename)
+    if match is None:
+        file_id.close()
+        raise IOError(filename + ' is part of a multi-file snapshot, '\
+                      'but is not named base.N.hdf5')
+    base, piece = match.group(1), int(match.group(2))
+    file_ids = []
+    for i in range(nfiles):
+        if i == piece:
+            file_ids.append(file_id)
+        else:
+            file_ids.append(h5py.File(base + '.%d.hdf5' %i, 'r', **options))
+    return MultiFile(file_ids)
+
 class File(object):
     """
     Class for Gadget2 HDF5 snapshot files.
@@ -21,9 +49,9 @@ class File(object):
     def __init__(self, sim, filename, **kwargs):
         self.sim = sim
         self.filename = filename
-        f = filename.replace('.hdf5','')
-        self.number = int(f.split('_')[-1])
-        self.file_id = h5py.File(filename, 'r')
+        f = os.path.basename(filename).replace('.hdf5','')
+        self.number = int(f.split('_')[-1].split('.')[0])
+        self.file_id = open_hdf5(filename, **sim.hdf5_options)
         self.header = Header(self.file_id)
         kwargs['refine'] = kwargs.pop('refine_nbody', False)
         self.define_ptype('dm', 1, PartTypeNbody, **kwargs)
@@ -42,6 +70,37 @@ class File(object):
     def keys(self):
         for key in self.file_id.keys():
             print key
+
+    def storage_report(self):
+        """
+        Return a DataFrame describing how each dataset is stored: layout,
+        chunk shape, compression filter and storage size relative to the
+        uncompressed data.  Multi-file snapshots get one row per piece.
+        """
+        file_ids = getattr(self.file_id, 'file_ids', [self.file_id])
+        rows = []
+        for piece, file_id in enumerate(file_ids):
+            datasets = []
+            file_id.visititems(lambda name, obj: datasets.append((name, obj))
+                               if isinstance(obj, h5py.Dataset) else None)
+            for name, dataset in datasets:
+                nbytes = dataset.size * dataset.dtype.itemsize
+                storage = dataset.id.get_storage_size()
+                rows.append({'piece':piece,
+                             'dataset':name,
+                             'shape':dataset.shape,
+                             'dtype':str(dataset.dtype),
+                             'chunks':dataset.chunks,
+                             'compression':dataset.compression,
+                             'compression_opts':dataset.compression_opts,
+                             'shuffle':dataset.shuffle,
+                             'nbytes':nbytes,
+                             'storage_size':storage,
+                             'ratio':float(storage)/nbytes if nbytes else 1.})
+        columns = ['piece', 'dataset', 'shape', 'dtype', 'chunks',
+                   'compression', 'compression_opts', 'shuffle',
+                   'nbytes', 'storage_size', 'ratio']
+        return pandas.DataFrame(rows, columns=columns)
         
     def close(self):
         try:
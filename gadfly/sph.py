@@ -4,7 +4,10 @@
 This module contains classes for reading Gadget2 SPH particle data.
 """
 import numpy
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from pandas import Series, DataFrame
+from scipy.spatial import cKDTree
 
 from nbody import PartTypeNbody
 import units
@@ -24,19 +27,6 @@ class PartTypeSPH(PartTypeNbody):
             print 'Turning on gas particle refinement.'
             self.refine_dataset()
 
-    def __getstate__(self):
-        result = self.__dict__.copy()
-        del result['_coordinates']
-        del result['_particleIDs']
-        del result['_velocities']
-        del result['_masses']
-        del result['_density']
-        del result['_smoothing_length']
-        del result['_internal_energy']
-        del result['_load_dict']
-        del result['loadable_keys']
-        return result
-
     def __setstate__(self, in_dict):
         self.__dict__ = in_dict
         self.__init_load_dict__()
@@ -59,25 +49,39 @@ class PartTypeSPH(PartTypeNbody):
             criterion = (self.masses > self.masses.min()) & (self.sink_value == 0.)
         super(PartTypeNbody, self).refine_dataset(criterion)
 
+    def _conversion(self, key, unit=None):
+        """
+        Return the factor converting dataset key from code units to unit
+        (default set in units class).
+        """
+        if key == 'density':
+            conv = self.units.densities[unit or self.units.density_unit]
+            if self.units.remove_h:
+                conv *= self._header.HubbleParam**2
+            if self.units.coordinate_system == 'physical':
+                ainv = self._header.Redshift + 1 # 1/(scale factor)
+                conv *= ainv**3
+        elif key == 'internal_energy':
+            conv = self.units.energies[unit or self.units.energy_unit]
+        elif key == 'smoothing_length':
+            conv = self.units.lengths[unit or self.units.length_unit]
+            if self.units.remove_h:
+                conv /= self._header.HubbleParam
+            if self.units.coordinate_system == 'physical':
+                conv *= self._header.ScaleFactor
+        else:
+            conv = super(PartTypeSPH, self)._conversion(key, unit)
+        return conv
+
     def load_density(self, unit=None):
         """
         Load Particle Densities in cgs units (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_density(unit)
-        density = self._density.value * self.units.density_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            density *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            density *= ainv**3
-        if self._drop_ids is not None:
-            density = Series(density, index=self._particleIDs.value)
-            self['density'] = density.drop(self._drop_ids)
-        else:
-            self['density'] = density
+        unit = unit or self.units.density_unit
+        density = self._converted('density', unit)
+        self._store(density, 'density')
+        self._loaded_units['density'] = unit
 
     def get_density(self, unit=None):
         """
@@ -85,7 +89,7 @@ class PartTypeSPH(PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.density_unit:
+            if unit != self._loaded_units.get('density'):
                 self.load_density(unit)
         try:
             return self.density
@@ -99,14 +103,10 @@ class PartTypeSPH(PartTypeNbody):
         (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units.set_energy(unit)
-        energy = self._internal_energy.value * self.units.energy_conv
-        if self._drop_ids is not None:
-            energy = Series(energy, index=self._particleIDs.value)
-            self['internal_energy'] = energy.drop(self._drop_ids)
-        else:
-            self['internal_energy'] = energy
+        unit = unit or self.units.energy_unit
+        energy = self._converted('internal_energy', unit)
+        self._store(energy, 'internal_energy')
+        self._loaded_units['internal_energy'] = unit
 
     def get_internal_energy(self, unit=None):
         """
@@ -114,7 +114,7 @@ class PartTypeSPH(PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units.energy_unit:
+            if unit != self._loaded_units.get('internal_energy'):
                 self.load_internal_energy(unit)
         try:
             return self.internal_energy
@@ -128,20 +128,10 @@ class PartTypeSPH(PartTypeNbody):
         (default set in units class)
         unit: unit conversion from code units
         """
-        if unit:
-            self.units._set_smoothing_length(unit)
-        hsml = self._smoothing_length.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            hsml /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            hsml *= a
-        if self._drop_ids is not None:
-            hsml = Series(hsml, index=self._particleIDs.value)
-            self['smoothing_length'] = hsml.drop(self._drop_ids)
-        else:
-            self['smoothing_length'] = hsml
+        unit = unit or self.units.length_unit
+        hsml = self._converted('smoothing_length', unit)
+        self._store(hsml, 'smoothing_length')
+        self._loaded_units['smoothing_length'] = unit
 
     def get_smoothing_length(self, unit=None):
         """
@@ -150,10 +140,93 @@ class PartTypeSPH(PartTypeNbody):
         unit: unit conversion from code units
         """
         if unit:
-            if unit != self.units._smoothing_unit:
+            if unit != self._loaded_units.get('smoothing_length'):
                 self.load_smoothing_length(unit)
         try:
             return self.smoothing_length
         except AttributeError:
             self.load_smoothing_length(unit)
-            return self.smoothing_length
\ No newline at end of file
+            return self.smoothing_length
+
+    def interpolate(self, field, points, normalize=False, **kwargs):
+        """
+        Return the SPH estimate of field at arbitrary points,
+        A(r) = sum_j m_j/rho_j A_j W(|r - r_j|, h_j), with the cubic spline
+        kernel of visualize.scalar_map.
+        field: loaded column or loadable key (e.g. 'density'), or a list of
+               columns (e.g. ['u', 'v', 'w']).
+        points: (N,3) positions, in the frame and units of the loaded x,y,z.
+        normalize: if True, divide by sum_j m_j/rho_j W, which corrects
+                   the estimate where the kernel sum is incomplete.
+        batch_size: number of points per batch (default 2**16).
+        threads: number of threads (default: one per core).
+        Returns an array of shape (N,), or (N, len(field)) for a list.
+        """
+        batch_size = kwargs.pop('batch_size', 2**16)
+        threads = kwargs.pop('threads', None) or mp.cpu_count()
+        single = isinstance(field, basestring)
+        columns = [field] if single else list(field)
+        missing = [key for key in columns if key not in self.columns]
+        if missing:
+            self.load_data(*missing)
+        values = numpy.asarray(self[columns].values, dtype=numpy.float64)
+        if 'x' not in self.columns:
+            self.load_coords()
+        xyz = numpy.asarray(self[['x', 'y', 'z']].values, dtype=numpy.float64)
+        unit = self._loaded_units.get('coordinates')
+        hsml = numpy.asarray(self._converted('smoothing_length', unit),
+                             dtype=numpy.float64)
+        # Particle volumes m/rho: code units, then coordinate units cubed.
+        density = numpy.asarray(self._raw_values('density'), numpy.float64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            volume = self._raw_values('masses') / density \
+                     * self._conversion('coordinates', unit)**3
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+
+        # Particles without a kernel (e.g. sinks or accreted particles, with
+        # zero smoothing length or density) contribute nothing.
+        valid = numpy.flatnonzero((hsml > 0) & (density > 0)
+                                  & numpy.isfinite(volume))
+        # Group particles by smoothing length (factors of 2), so that the
+        # search radius of each tree is close to its particles' hsml.
+        trees = []
+        if valid.size:
+            hbin = numpy.floor(numpy.log2(hsml[valid] / hsml[valid].min()))
+            hbin = hbin.astype(int)
+            for b in numpy.unique(hbin):
+                rows = valid[hbin == b]
+                trees.append((rows, cKDTree(xyz[rows]), hsml[rows].max()))
+
+        def sample(start):
+            batch = points[start:start+batch_size]
+            result = numpy.zeros((batch.shape[0], len(columns)))
+            weights = numpy.zeros(batch.shape[0])
+            batch_tree = cKDTree(batch)
+            for rows, tree, hmax in trees:
+                pairs = batch_tree.sparse_distance_matrix(tree, hmax,
+                                                    output_type='ndarray')
+                i = pairs['i']
+                j = rows[pairs['j']]
+                h = hsml[j]
+                q = pairs['v'] / h
+                inside = q < 1
+                i, j, h, q = i[inside], j[inside], h[inside], q[inside]
+                W = numpy.where(q <= 0.5, 1 - 6*q**2 + 6*q**3, 2*(1 - q)**3)
+                W *= 8 / (numpy.pi * h**3) * volume[j]
+                weights += numpy.bincount(i, W, batch.shape[0])
+                for c in range(len(columns)):
+                    result[:,c] += numpy.bincount(i, W * values[j,c],
+                                                  batch.shape[0])
+            if normalize:
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    result = numpy.where(weights[:,None] > 0,
+                                         result / weights[:,None], 0)
+            return result
+
+        starts = range(0, points.shape[0], batch_size)
+        pool = ThreadPool(max(min(threads, len(starts)), 1))
+        try:
+            result = numpy.concatenate(pool.map(sample, starts))
+        finally:
+            pool.close()
+        return result[:,0] if single else result
@@ -0,0 +1,56 @@
+# transport.py
+"""
+This module contains a shared-memory transport for handing loaded
+snapshots from a loader to compute processes without copying their
+particle data through a pipe.
+"""
+import os
+import tempfile
+import cPickle as pickle
+from cStringIO import StringIO
+import numpy
+
+# Arrays smaller than this are pickled inline.
+MIN_SHARED_BYTES = 2**16
+
+def shared_directory():
+    """
+    Create a directory for shared arrays, in /dev/shm where available.
+    """
+    if os.path.isdir('/dev/shm'):
+        return tempfile.mkdtemp(prefix='gadfly-', dir='/dev/shm')
+    return tempfile.mkdtemp(prefix='gadfly-')
+
+def dump(obj, directory):
+    """
+    Pickle obj, writing every large numpy array it contains (DataFrame
+    columns, indices, ...) to its own file in directory instead of into
+    the pickle.  Returns the (small) pickle string.
+    """
+    def persistent_id(value):
+        if (isinstance(value, numpy.ndarray) and not value.dtype.hasobject
+            and value.nbytes >= MIN_SHARED_BYTES):
+            fd, fname = tempfile.mkstemp(suffix='.npy', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, value)
+            return fname
+        return None
+    buf = StringIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return buf.getvalue()
+
+def load(payload):
+    """
+    Unpickle an object written by dump.  Shared arrays are attached as
+    copy-on-write memory maps, so the data is not copied unless it is
+    modified, and their files are unlinked once mapped.
+    """
+    def persistent_load(fname):
+        values = numpy.load(fname, mmap_mode='c')
+        os.remove(fname)
+        return numpy.asarray(values)
+    unpickler = pickle.Unpickler(StringIO(payload))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
@@ -19,6 +19,9 @@ def scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
     """
     # !!!!! x and y are reversed in the c-code below - no idea why/how...
     # !!!!! (Hence the reversal above)
+    # Weights are scalar**2 times scalar: out of float32 range for
+    # typical densities, so accumulate in double precision.
+    scalar_field = numpy.asarray(scalar_field, dtype=numpy.float64)
     zi = numpy.zeros(zshape)
     nzi = numpy.zeros_like(zi)
     N_gas = scalar_field.size
@@ -115,6 +118,9 @@ def scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
 
 #===============================================================================
 def py_scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
+    # Weights are scalar**2 times scalar: out of float32 range for
+    # typical densities, so accumulate in double precision.
+    scalar_field = numpy.asarray(scalar_field, dtype=numpy.float64)
     zi = numpy.zeros(zshape)
     nzi = numpy.zeros_like(zi)
     i_min = (x - hsml + width/2.0) / width*pps
@@ -164,6 +170,9 @@ def numba_loop(y,x,scalar_field,hsml,zi,nzi,weight,npart,width,pps,i_min,i_max,j
                             nzi[i][j] += weight[n] * W_x
     return zi, nzi
 def numba_scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
+    # Weights are scalar**2 times scalar: out of float32 range for
+    # typical densities, so accumulate in double precision.
+    scalar_field = numpy.asarray(scalar_field, dtype=numpy.float64)
     zi = numpy.zeros(zshape)
     nzi = numpy.zeros_like(zi)
     i_min = (x - hsml + width/2.0) / width*pps